@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import collections
 import contextlib
+import itertools
 import json
 import os
+import selectors
 import socket
-import struct
+import threading
+import time
 import boldui.hotrefresh
+from boldui import patch, wire
 from simplexp import Expr, var, Oplist
 from typing import List
 
@@ -16,6 +21,9 @@ class Actions:
     HANDLER_REPLY = 1
     SET_VAR = 2
     WATCH_ACK = 3
+    SCENE_PATCH = 4
+    SCENE_UNCHANGED = 5
+    SHUTDOWN = 6
 
 
 def stringify_op(obj, indent=0):
@@ -48,17 +56,19 @@ def stringify_op(obj, indent=0):
 
 
 class Ops:
+    # Rects are stored as lists, like they come back from the wire (e.g. in a snapshot), so the same scene built again
+    # compares equal to it
     @staticmethod
     def clear(color):
         return {'type': 'clear', 'color': color}
 
     @staticmethod
     def rect(rect, color):
-        return {'type': 'rect', 'rect': rect, 'color': color}
+        return {'type': 'rect', 'rect': list(rect), 'color': color}
 
     @staticmethod
     def rrect(rect, color, radius):
-        return {'type': 'rrect', 'rect': rect, 'color': color, 'radius': radius}
+        return {'type': 'rrect', 'rect': list(rect), 'color': color, 'radius': radius}
 
     @staticmethod
     def reply(ident: int, data: List[Expr | int | float | None]):
@@ -72,7 +82,7 @@ class Ops:
     def event_handler(rect, events, handler, oplist):
         return {
             'type': 'evtHnd',
-            'rect': rect,
+            'rect': list(rect),
             'events': events,
             'handler': handler,
             'oplist': oplist,
@@ -120,30 +130,199 @@ class Ops:
 
     @staticmethod
     def clip_rect(rect):
-        return {'type': 'clipRect', 'rect': rect}
+        return {'type': 'clipRect', 'rect': list(rect)}
 
     @staticmethod
     def image(uri, rect):
-        return {'type': 'image', 'uri': uri, 'rect': rect}
+        return {'type': 'image', 'uri': uri, 'rect': list(rect)}
+
+
+class PendingClient:
+    """
+    A connection still in its handshake, read as the bytes come in so a slow client doesn't hold up the serve loop.
+    """
+    def __init__(self, sock, addr, deadline):
+        self.socket = sock
+        self.addr = addr
+        self.deadline = deadline
+        self.version = None
+        self.features = None
+        self.cached_hash = None
+        self._received = bytearray()
+        self._expected = 8
+
+    def read(self) -> bool:
+        """
+        Reads what has arrived, returns True once the handshake is complete. Raises ValueError on a bad header and
+        ConnectionError if the client hangs up.
+        """
+        data = self.socket.recv(self._expected - len(self._received))
+        if not data:
+            raise ConnectionError('Client hung up during the handshake')
+        self._received += data
+        if len(self._received) < self._expected:
+            return False
+        received = bytes(self._received)
+        self._received.clear()
+
+        if self.version is None:
+            # The client answers with the newest version it knows, one newer than ours tries again with version 1
+            if received[:7] != wire.PROTOCOL_MAGIC or not wire.PROTOCOL_JSON <= received[7] <= wire.PROTOCOL_LATEST:
+                raise ValueError('Invalid header')
+            self.version = received[7]
+            if self.version < wire.PROTOCOL_FEATURES:
+                self.features = 0
+                return True
+            # Nothing else was sent on this socket yet, so the few bytes fit in its buffer
+            self.socket.send(wire.SUPPORTED_FEATURES.to_bytes(4, 'big'))
+            self._expected = 4
+            return False
+
+        if self.features is None:
+            self.features = int.from_bytes(received, 'big') & wire.SUPPORTED_FEATURES
+            if self.features & wire.FEATURE_SCENE_HASH:
+                self._expected = wire.SCENE_HASH_SIZE
+                return False
+            return True
+
+        self.cached_hash = received
+        return True
+
+
+class ClientConnection:
+    # sendmsg() takes at most IOV_MAX (1024 on Linux) buffers at a time
+    MAX_WRITE_BUFFERS = 512
+
+    def __init__(self, sock, addr, protocol_version, features=0):
+        self.socket = sock
+        self.addr = addr
+        self.protocol_version = protocol_version
+        self.features = features
+        self.binary = wire.binary_payloads(protocol_version, features)
+        # SCENE_PATCH came along with version 2, version 1 clients only know full scenes
+        self.patches = protocol_version >= wire.PROTOCOL_BINARY
+        self.reader = wire.PacketReader(sock)
+        # Packets not written yet. The socket is non-blocking, so a client that stops reading only fills this up
+        # instead of holding up the server and the other clients.
+        self.output = collections.deque()
+        self._output_lock = threading.Lock()
+        # When the client last took some of the output, None when there's none left
+        self.last_write = None
+
+        self.compressor = None
+        if features & wire.FEATURE_ZSTD:
+            self.compressor = wire.Compressor(wire.FEATURE_ZSTD)
+        elif features & wire.FEATURE_ZLIB:
+            self.compressor = wire.Compressor(wire.FEATURE_ZLIB)
+
+    def send_packet(self, *parts):
+        """
+        Queues the parts as a single length-prefixed packet, and writes as much of the output as the socket takes.
+        """
+        buffers = [memoryview(part) for part in parts if part]
+        with self._output_lock:
+            self.output.append(memoryview(sum(len(buffer) for buffer in buffers).to_bytes(4, 'big')))
+            self.output.extend(buffers)
+            if self.last_write is None:
+                self.last_write = time.monotonic()
+        self.write()
+
+    def write(self):
+        """
+        Writes queued output until the socket's buffer is full. On errors the output is dropped and OSError raised.
+        """
+        with self._output_lock:
+            output = self.output
+            while output:
+                try:
+                    sent = self.socket.sendmsg(list(itertools.islice(output, ClientConnection.MAX_WRITE_BUFFERS)))
+                except BlockingIOError:
+                    return
+                except OSError:
+                    output.clear()
+                    self.last_write = None
+                    raise
+
+                self.last_write = time.monotonic()
+                # Drop what was written, the kernel may stop in the middle of a buffer
+                while sent and sent >= len(output[0]):
+                    sent -= len(output.popleft())
+                if sent:
+                    output[0] = output[0][sent:]
+            self.last_write = None
 
 
 class ProtocolServer:
-    def __init__(self, address, reply_handler=None):
+    SYSTEMD_SOCK_FD = 3
+    # Seconds a new connection gets to finish its handshake
+    HANDSHAKE_TIMEOUT = 5
+    # Seconds a client may go without reading anything we have for it before it's dropped
+    SEND_TIMEOUT = 10
+    # Recently sent scenes kept around, so a reconnecting client with one of them cached only needs a patch
+    SCENE_HISTORY = 8
+
+    def __init__(self, address, reply_handler=None, max_clients=1, listen_fd=SYSTEMD_SOCK_FD, frame_budget=0.0,
+                 idle_timeout=None, on_idle=None, snapshot_path=None):
+        """
+        With `max_clients` > 1 the same app is mirrored to several clients at once: every scene / var update is
+        encoded once per encoding (JSON or binary) and the same bytes are sent to all of them, while replies from any
+        client are handled one at a time on the serving thread.
+
+        Scene and var updates aren't sent right away, they're coalesced (keeping the last value of each var) and sent
+        as a single packet at the end of the current serve loop iteration, or `frame_budget` seconds after the first
+        one if it's set.
+
+        With `idle_timeout` set, serve() returns after that many seconds without any packet from the clients: it
+        calls `on_idle`, saves the last scene to `snapshot_path` (see load_snapshot) and tells the clients it's going
+        away, so they can wake it back up through socket activation.
+
+        Clients never block the serve loop: a connection that doesn't finish its handshake within HANDSHAKE_TIMEOUT
+        or stops reading for SEND_TIMEOUT is dropped.
+        """
         self.pending_vars = {}
         self.address = address
         self._scene = None
         self._cached_scene = None
+        # Last scene the clients got, and the one built from self.scene (without pushed var values)
+        self._sent_scene = None
+        self._sent_snapshot = None
+        self._scene_snapshot = None
+        # Encoded full scene per encoding (binary or not), for the scene of this snapshot
+        self._encoded_snapshot = None
+        self._encoded_scene = {}
+        # Snapshots of the last scenes sent, oldest first
+        self._scene_history = collections.deque(maxlen=ProtocolServer.SCENE_HISTORY)
         self.reply_handler = reply_handler
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle
+        self.snapshot_path = snapshot_path or f'{address}.snapshot'
+        self._last_activity = time.monotonic()
         if os.path.exists(address):
             os.remove(address)
 
-        SYSTEMD_SOCK_FD = 3
-        self.server = socket.fromfd(SYSTEMD_SOCK_FD, socket.AF_UNIX, socket.SOCK_STREAM)
-        self.socket = None
-
+        self.server = socket.fromfd(listen_fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        self.max_clients = max_clients
+        self.clients: List[ClientConnection] = []
+        self._handshakes: List[PendingClient] = []
+        self._selector = None
+        self._listening = False
+        # bytes_raw: payload bytes before compression, bytes_sent: bytes written to sockets (including framing),
+        # compress_time: seconds spent compressing, sends_avoided: updates that were merged into another packet,
+        # encode_hits / encode_misses: full scene sends served from / added to the encoded scene cache,
+        # scenes_unchanged: rebuilds identical to the last scene sent, scene_sends_skipped: those that sent nothing
+        self.stats = collections.Counter()
+
+        self.frame_budget = frame_budget
         self._is_batch = False
-        self._batch_scene_updated = False
-        self._batch_vars = None
+        self._pending_lock = threading.RLock()
+        self._pending_scene = False
+        self._pending_set_vars = {}
+        self._pending_acks = []
+        self._pending_count = 0
+        self._flush_deadline = None
+        self._serving_thread = None
+        # Lets other threads (e.g. hot refresh) wake the serve loop up to flush their updates
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
 
         hotrefresh.init(self)
 
@@ -159,133 +338,462 @@ class ProtocolServer:
 
     @scene.setter
     def scene(self, value):
-        self._scene = value
-        self._cached_scene = None
-        if self._is_batch:
-            self._batch_scene_updated = True
-        else:
-            self._send_scene()
+        with self._pending_lock:
+            self._scene = value
+            self._cached_scene = None
+            self._scene_snapshot = None
+            self._pending_scene = True
+            self._queued_update()
 
     def refresh_scene(self):
-        self._cached_scene = None
-        if self._is_batch:
-            self._batch_scene_updated = True
-        else:
-            self._send_scene()
+        with self._pending_lock:
+            self._cached_scene = None
+            self._scene_snapshot = None
+            self._pending_scene = True
+            self._queued_update()
 
     @contextlib.contextmanager
     def batch_update(self):
         assert not self._is_batch
 
         self._is_batch = True
-        self._batch_scene_updated = False
-        self._batch_vars = {}
-
         yield
-
-        if self._batch_scene_updated:
-            self._send_scene()
-        elif self._batch_vars:
-            self._send_remote_var([(name, val) for name, val in self._batch_vars.items()])
-
         self._is_batch = False
-        self._batch_scene_updated = False
-        self._batch_vars = None
+
+        if self._pending_count:
+            self._schedule_flush()
+
+    def _queued_update(self):
+        self._pending_count += 1
+        if not self._is_batch:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        with self._pending_lock:
+            if self._flush_deadline is None:
+                self._flush_deadline = time.monotonic() + self.frame_budget
+                if threading.get_ident() != self._serving_thread:
+                    self._wakeup_send.send(b'\x00')
+
+    def flush(self):
+        """
+        Sends all pending scene / var updates and watch acks now.
+        """
+        if self._pending_scene and self.clients:
+            # Rebuild first, the build may set vars that should go out along with the scene
+            _ = self.scene
+
+        with self._pending_lock:
+            scene_updated, set_vars, acks = self._pending_scene, self._pending_set_vars, self._pending_acks
+            self.stats['sends_avoided'] += max(self._pending_count - 1, 0)
+            self._pending_scene = False
+            self._pending_set_vars = {}
+            self._pending_acks = []
+            self._pending_count = 0
+            self._flush_deadline = None
+
+        if scene_updated:
+            self._send_scene(set_vars)
+        elif set_vars:
+            self._send_remote_var([(name, val) for name, val in set_vars.items()])
+
+        # After the updates, so the client re-evaluates the watch with the new values
+        for ack_id in acks:
+            self._send_packet(Actions.WATCH_ACK, lambda _binary: ack_id.to_bytes(8, 'big'))
 
     def serve(self):
+        self._serving_thread = threading.get_ident()
+        self._selector = selectors.DefaultSelector()
+        self.server.listen(self.max_clients)
+        self._update_listening()
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        print('Waiting for connection...')
+
         while True:
-            print('Waiting for connection...')
-            self.server.listen(1)
-            self.socket, addr = self.server.accept()
-
-            print('Client connected', addr)
-            self.socket.send(b"BoldUI\x00\x01")
-
-            # Read header
-            header = self.socket.recv(8)
-            if header != b"BoldUI\x00\x01":
-                print("Invalid header, disconnecting")
-                break
-
-            print("Handshake complete, sending initial scene")
-            if self.scene:
-                self._send_scene()
-            for var in self.pending_vars:
-                self.set_remote_var(var, self.pending_vars[var][0], self.pending_vars[var][1])
-
-            print(f'Server PID is {os.getpid()}')
-            while True:
-                packet = b''
-                packet_length = self.socket.recv(4)
-                if not packet_length:
-                    break
-
-                packet_length = int.from_bytes(packet_length, 'big')
-                while len(packet) < packet_length:
-                    packet += self.socket.recv(packet_length - len(packet))
-                    if not packet:
-                        break
-
-                self._handle_packet(packet)
-
-            print('Client disconnected')
-            break
-
-    def _send_packet(self, packet):
-        # print('Sending packet:', packet)
-        self.socket.send(len(packet).to_bytes(4, 'big') + packet)
+            deadlines = [self._flush_deadline]
+            deadlines.extend(handshake.deadline for handshake in self._handshakes)
+            deadlines.extend(client.last_write + ProtocolServer.SEND_TIMEOUT for client in self.clients
+                             if client.last_write is not None)
+            if self.idle_timeout is not None and self.clients:
+                deadlines.append(self._last_activity + self.idle_timeout)
+            deadlines = [deadline for deadline in deadlines if deadline is not None]
+            timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+
+            # Only wait for room in the sockets of clients with output left to write
+            for client in self.clients:
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.output else 0)
+                if self._selector.get_key(client.socket).events != events:
+                    self._selector.modify(client.socket, events, client)
+
+            was_connected = bool(self.clients or self._handshakes)
+            for key, events in self._selector.select(timeout):
+                if key.fileobj is self._wakeup_recv:
+                    self._wakeup_recv.recv(4096)
+                elif key.fileobj is self.server:
+                    self._accept()
+                elif isinstance(key.data, PendingClient):
+                    self._read_handshake(key.data)
+                else:
+                    if events & selectors.EVENT_WRITE:
+                        self._write(key.data)
+                    if events & selectors.EVENT_READ:
+                        self._read(key.data)
+
+            now = time.monotonic()
+            for handshake in [handshake for handshake in self._handshakes if now >= handshake.deadline]:
+                print('Handshake timed out, disconnecting', handshake.addr)
+                self._drop(handshake)
+            for client in [client for client in self.clients
+                           if client.last_write is not None and now - client.last_write >= ProtocolServer.SEND_TIMEOUT]:
+                print('Client stopped reading, disconnecting', client.addr)
+                self._drop(client)
+            if was_connected and not self.clients and not self._handshakes:
+                return
+
+            if self._flush_deadline is not None and time.monotonic() >= self._flush_deadline:
+                self.flush()
+
+            if self.idle_timeout is not None and self.clients and \
+                    time.monotonic() - self._last_activity >= self.idle_timeout:
+                self._shut_down_idle()
+                return
+
+    def _shut_down_idle(self):
+        print(f'No activity for {self.idle_timeout}s, shutting down')
+        self.flush()
+        if self.on_idle:
+            self.on_idle()
+        self.write_snapshot()
+
+        self._send_packet(Actions.SHUTDOWN, lambda _binary: b'')
+        for client in self.clients:
+            # Give the rest of the output a moment to get through, the client can't hold us up for long anymore
+            client.socket.settimeout(1)
+            with contextlib.suppress(OSError):
+                client.write()
+            client.socket.close()
+        for handshake in self._handshakes:
+            handshake.socket.close()
+        self.clients.clear()
+        self._handshakes.clear()
+
+    def write_snapshot(self):
+        """
+        Saves the last scene sent and the remote var values for load_snapshot().
+        """
+        if self._sent_scene is None:
+            return
+
+        snapshot = {
+            # Exactly what the clients have, so they can tell it's the same scene when they reconnect
+            'scene': self._sent_scene,
+            'vars': {
+                name: [val_type, value] for name, (val_type, value) in self.pending_vars.items()
+                if isinstance(value, (int, float, str))
+            },
+        }
+        temp_path = f'{self.snapshot_path}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(wire.encode(snapshot))
+        os.replace(temp_path, self.snapshot_path)
+
+    def load_snapshot(self):
+        """
+        Returns the scene saved by the last idle shutdown (and restores the remote vars), or None. It's only good for
+        one restart, so it's removed.
+        """
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.remove(self.snapshot_path)
+
+        try:
+            snapshot = wire.decode(data)
+        except Exception as e:
+            print('Ignoring broken scene snapshot', self.snapshot_path, e)
+            return None
+
+        for name, (val_type, value) in snapshot['vars'].items():
+            self.pending_vars.setdefault(name, (val_type, value))
+        return snapshot['scene']
+
+    def _update_listening(self):
+        # Stop accepting while at max_clients, counting the connections still in their handshake
+        listening = len(self.clients) + len(self._handshakes) < self.max_clients
+        if listening != self._listening:
+            if listening:
+                self._selector.register(self.server, selectors.EVENT_READ)
+            else:
+                self._selector.unregister(self.server)
+            self._listening = listening
+
+    def _accept(self):
+        sock, addr = self.server.accept()
+
+        print('Client connected', addr)
+        sock.setblocking(False)
+        # Version 1 whatever we speak, clients from before version 2 accept nothing else. Newer ones answer with the
+        # newest version they know, which we take if we know it too. Nothing else was sent on this socket yet, so the
+        # few bytes fit in its buffer.
+        sock.send(wire.PROTOCOL_MAGIC + bytes([wire.PROTOCOL_JSON]))
+
+        handshake = PendingClient(sock, addr, time.monotonic() + ProtocolServer.HANDSHAKE_TIMEOUT)
+        self._handshakes.append(handshake)
+        self._selector.register(sock, selectors.EVENT_READ, handshake)
+        self._update_listening()
+
+    def _read_handshake(self, handshake):
+        try:
+            if not handshake.read():
+                return
+        except BlockingIOError:
+            return
+        except (OSError, ValueError) as e:
+            print('Handshake failed, disconnecting', handshake.addr, e)
+            self._drop(handshake)
+            return
+
+        self._handshakes.remove(handshake)
+        client = ClientConnection(handshake.socket, handshake.addr, handshake.version, handshake.features)
+        self._selector.modify(client.socket, selectors.EVENT_READ, client)
+        self._add_client(client, handshake.cached_hash)
+
+    def _add_client(self, client, cached_hash):
+        print("Handshake complete, sending initial scene")
+        self._last_activity = time.monotonic()
+        is_first = not self.clients
+        if not is_first:
+            # Get the others up to date first, the newcomer starts from the same scene they have
+            self.flush()
+        self.clients.append(client)
+        if self.scene:
+            if is_first:
+                self._sent_scene = self.scene
+                self._sent_snapshot = self._current_snapshot()
+            self._send_initial_scene(client, cached_hash)
+        if self.pending_vars:
+            self._send_remote_var([(name, value) for name, (_, value) in self.pending_vars.items()], [client])
+        if is_first:
+            # Nobody else is waiting for the updates queued so far, the newcomer got all of that just now
+            with self._pending_lock:
+                self._pending_scene = False
+                self._pending_set_vars = {}
+                self._pending_count = 0
+
+        print(f'Server PID is {os.getpid()}')
+
+    def _read(self, client):
+        try:
+            packet = client.reader.read_packet()
+        except BlockingIOError:
+            # The rest of the packet isn't there yet
+            return
+        except OSError as e:
+            print('Failed to read from client', client.addr, e)
+            packet = None
+        if packet is None:
+            print('Client disconnected', client.addr)
+            self._drop(client)
+            return
+
+        self._last_activity = time.monotonic()
+        self._handle_packet(packet)
+
+    def _write(self, client):
+        try:
+            client.write()
+        except OSError as e:
+            # It'll be dropped once the serving loop notices the connection is gone
+            print('Failed to send to client', client.addr, e)
+
+    def _drop(self, connection):
+        self._selector.unregister(connection.socket)
+        connection.socket.close()
+        if isinstance(connection, PendingClient):
+            self._handshakes.remove(connection)
+        else:
+            self.clients.remove(connection)
+        self._update_listening()
+
+    def _send_packet(self, action, make_payload, clients=None):
+        # Encode once per encoding in use, and send the same bytes to every client using it. Compression contexts are
+        # per connection though, so that part is done for each client.
+        payloads = {}
+        header = action.to_bytes(4, 'big')
+        for client in self.clients if clients is None else clients:
+            payload = payloads.get(client.binary)
+            if payload is None:
+                payload = payloads[client.binary] = make_payload(client.binary)
+            self.stats['bytes_raw'] += len(payload)
+
+            if client.compressor and len(payload) >= wire.COMPRESSION_THRESHOLD:
+                start = time.perf_counter()
+                client_header = (action | wire.COMPRESSED).to_bytes(4, 'big')
+                client_payload = client.compressor.compress(payload)
+                self.stats['compress_time'] += time.perf_counter() - start
+            else:
+                client_header = header
+                client_payload = payload
+            self.stats['bytes_sent'] += 8 + len(client_payload)
+
+            try:
+                client.send_packet(client_header, client_payload)
+            except OSError as e:
+                # It'll be dropped once the serving loop notices the connection is gone
+                print('Failed to send to client', client.addr, e)
+                continue
+            if client.output and threading.get_ident() != self._serving_thread:
+                # So the serve loop waits for the socket to take the rest
+                self._wakeup_send.send(b'\x00')
 
     def _handle_packet(self, packet):
         action = int.from_bytes(packet[:4], 'big')
         data = packet[4:]
         if action == Actions.HANDLER_REPLY:
-            reply_count = int.from_bytes(data[:2], 'big')
-            data = data[2:]
             with self.batch_update():
-                for i in range(reply_count):
-                    reply_len = int.from_bytes(data[:2], 'big')
-                    reply_id = int.from_bytes(data[2:6], 'big')
-                    reply_data = data[6:6+reply_len]
-                    data_array = []
-                    while reply_data:
-                        item_type = reply_data[0]
-                        if item_type == 0:
-                            data_array.append(int.from_bytes(reply_data[1:9], 'big', signed=True))
-                            reply_data = reply_data[9:]
-                        elif item_type == 1:
-                            data_array.append(struct.unpack('>d', reply_data[1:9])[0])
-                            reply_data = reply_data[9:]
-                        else:
-                            raise ValueError(f"Unknown item type {item_type}")
+                for reply_id, data_array in wire.decode_replies(data):
                     if self.reply_handler:
                         # print(f'Reply: {hex(reply_id)} : {data_array}')
                         self.reply_handler(reply_id, data_array)
         else:
-            print('[app] Unknown packet type:', packet)
+            print('[app] Unknown packet type:', bytes(packet))
+
+    def _current_snapshot(self):
+        # Kept until the scene is replaced or refreshed, so reconnects don't serialize it again
+        if self._scene_snapshot is None:
+            self._scene_snapshot = patch.SceneSnapshot(self.scene)
+        return self._scene_snapshot
 
-    def _send_scene(self):
-        if self.socket:
+    def _send_scene(self, set_vars=None):
+        if self.clients:
             combined_scene = self.scene
-            if self._batch_vars is not None:
-                for key, value in self._batch_vars.items():
-                    combined_scene['vars'][key]['value'] = json.dumps(Oplist(Expr.to_dict(value)).to_list())
-            self._send_packet(Actions.UPDATE_SCENE.to_bytes(4, 'big') + json.dumps(self.scene).encode())
+            if set_vars:
+                combined_scene = self._with_var_values(combined_scene, set_vars)
+                snapshot = patch.SceneSnapshot(combined_scene)
+            else:
+                snapshot = self._current_snapshot()
+
+            if self._sent_snapshot is not None and snapshot.same_as(self._sent_snapshot):
+                self._send_unchanged_scene(set_vars)
+                return
+            self._remember_snapshot(snapshot)
+
+            if self._sent_snapshot is not None:
+
+                # Send only what changed since the last scene the clients got, unless most of it changed anyway
+                scene_patch, changed = patch.diff(self._sent_snapshot, snapshot, combined_scene)
+                if changed * 2 < len(snapshot.oplist) + len(snapshot.scene):
+                    self._sent_scene = combined_scene
+                    self._sent_snapshot = snapshot
+                    patching = [client for client in self.clients if client.patches]
+                    others = [client for client in self.clients if not client.patches]
+                    if patching:
+                        self._send_packet(Actions.SCENE_PATCH, lambda binary: self._encode(scene_patch, binary),
+                                          patching)
+                    if others:
+                        self._send_full_scene(combined_scene, snapshot, others)
+                    return
+
+            self._sent_scene = combined_scene
+            self._sent_snapshot = snapshot
+            self._send_full_scene(combined_scene, snapshot)
+
+    @staticmethod
+    def _with_var_values(scene, set_vars):
+        # Copy the parts we change, the built scene is sent again as is to clients connecting later
+        scene = {**scene, 'vars': dict(scene['vars'])}
+        for key, value in set_vars.items():
+            scene['vars'][key] = {**scene['vars'][key], 'value': json.dumps(Oplist(Expr.to_dict(value)).to_list())}
+        return scene
+
+    def _send_unchanged_scene(self, set_vars):
+        self.stats['scenes_unchanged'] += 1
+        if set_vars:
+            # The clients may have changed these locally since, they're applied again along with every scene
+            self._send_remote_var([(name, val) for name, val in set_vars.items()])
+
+        # Watches waiting for a roundtrip are unblocked by any scene update, and the server can't tell whether the
+        # clients are waiting on this one
+        if not any(op.get('type') == 'watch' and op.get('waitForRoundtrip') for op in self._sent_scene['scene']):
+            self.stats['scene_sends_skipped'] += 1
+            return
+
+        # Clients without scene caches don't know SCENE_UNCHANGED, an empty patch does the same, and version 1 clients
+        # don't know patches either
+        caching = [client for client in self.clients if client.features & wire.FEATURE_SCENE_HASH]
+        patching = [client for client in self.clients if client.patches and client not in caching]
+        others = [client for client in self.clients if not client.patches]
+        if caching:
+            self._send_packet(Actions.SCENE_UNCHANGED, lambda _binary: b'', caching)
+        if patching:
+            self._send_packet(Actions.SCENE_PATCH, lambda binary: self._encode({}, binary), patching)
+        if others:
+            self._send_full_scene(self._sent_scene, self._sent_snapshot, others)
+
+    def _send_initial_scene(self, client, cached_hash):
+        current = self._sent_snapshot
+        self._remember_snapshot(current)
+        if cached_hash == current.content_hash():
+            print('Client has the current scene cached')
+            self._send_packet(Actions.SCENE_UNCHANGED, lambda _binary: b'', [client])
+            return
+
+        # Newest first, hashing the snapshots only goes as far as needed
+        cached = next((snapshot for snapshot in reversed(self._scene_history)
+                       if snapshot.content_hash() == cached_hash), None)
+        if cached is not None:
+            scene_patch, _ = patch.diff(cached, current, self._sent_scene)
+            self._send_packet(Actions.SCENE_PATCH, lambda binary: self._encode(scene_patch, binary), [client])
+            return
+
+        self._send_full_scene(self._sent_scene, current, [client])
+
+    def _remember_snapshot(self, snapshot):
+        # Only clients that cache scenes can ever ask for an old one
+        if any(client.features & wire.FEATURE_SCENE_HASH for client in self.clients):
+            if not self._scene_history or self._scene_history[-1] is not snapshot:
+                self._scene_history.append(snapshot)
+
+    def _send_full_scene(self, scene, snapshot, clients=None):
+        if self._encoded_snapshot is not snapshot:
+            self._encoded_snapshot = snapshot
+            self._encoded_scene = {}
+
+        def make_payload(binary):
+            payload = self._encoded_scene.get(binary)
+            if payload is None:
+                self.stats['encode_misses'] += 1
+                payload = self._encoded_scene[binary] = self._encode(scene, binary)
+            else:
+                self.stats['encode_hits'] += 1
+            return payload
+
+        self._send_packet(Actions.UPDATE_SCENE, make_payload, clients)
+
+    @staticmethod
+    def _encode(value, binary) -> bytes:
+        if binary:
+            return wire.encode(value)
+        return json.dumps(value).encode()
 
     def set_remote_var(self, name, val_type, value):
-        self.pending_vars[name] = (val_type, value)
-        if self._is_batch:
-            self._batch_vars[name] = value
-        else:
-            self._send_remote_var([(name, value)])
+        with self._pending_lock:
+            self.pending_vars[name] = (val_type, value)
+            self._pending_set_vars[name] = value
+            self._queued_update()
 
-    def _send_remote_var(self, set_vars):
-        if self.socket:
+    def _send_remote_var(self, set_vars, clients=None):
+        if self.clients if clients is None else clients:
             parts = []
             for name, value in set_vars:
                 value = Oplist(Expr.to_dict(value)).to_list()
                 parts.append(name.encode() + b'\x00' + json.dumps(value).encode())
-            self._send_packet(Actions.SET_VAR.to_bytes(4, 'big') + b'\x00'.join(parts))
+            payload = b'\x00'.join(parts)
+            self._send_packet(Actions.SET_VAR, lambda _binary: payload, clients)
 
     def send_watch_ack(self, ack_id: int):
-        if self.socket:
-            self._send_packet(Actions.WATCH_ACK.to_bytes(4, 'big') + ack_id.to_bytes(8, 'big'))
+        with self._pending_lock:
+            self._pending_acks.append(ack_id)
+            self._schedule_flush()
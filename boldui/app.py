@@ -1,7 +1,8 @@
 import contextlib
+import threading
 
-from boldui import ProtocolServer, Oplist, Expr, var
-from boldui.framework import Widget, Clear, export, Context
+from boldui import ProtocolServer, Oplist, Expr, var, patch
+from boldui.framework import Widget, Clear, BuildIds, export, Context
 from boldui.store import BaseModel
 
 _TYPE_TO_TYPENAME = {
@@ -34,35 +35,79 @@ def stateful_widget(fn):
     return outer
 
 
+def _scene_build(scene):
+    """
+    Returns the number of the build (see BuildIds) that made the scene, from its reply / watch IDs, or None.
+    """
+    builds = set()
+
+    def visit(ops):
+        for op in ops:
+            if not isinstance(op, dict):
+                continue
+            if op.get('type') in ('reply', 'watch') and isinstance(op.get('id'), int):
+                builds.add(BuildIds.build_of(op['id']))
+            for key in ('handler', 'then', 'else'):
+                if isinstance(op.get(key), list):
+                    visit(op[key])
+
+    visit(scene['scene'])
+    builds.discard(0)
+    return builds.pop() if len(builds) == 1 else None
+
+
 class App:
     _curr_context = None
+    # Reply handlers of the last builds are kept, replies to a scene a few builds old still reach the right closure
+    KEPT_BUILDS = 8
 
     def __init__(self, scene, durable_model=None):
         self.scene = scene
         self._scene_instance = None
         self.server = None
         self.durable_model: BaseModel = durable_model
+        self._build_number = 0
+        # The current build's reply handlers, and those of the last builds by build number, oldest first
         self._reply_handlers = {}
+        self._build_handlers = {}
         self._txn_active = False
         self._last_read_items = set()
         self._dirty = False
+        # Builds and reply handlers share the model and the global framework Context, the startup build may run on
+        # another thread
+        self._build_lock = threading.RLock()
+        self._prebuilt_scene = None
+        # Replies can't be handled before the first build registered the handlers
+        self._handlers_ready = threading.Event()
 
     def force_rebuild(self):
         return self.rebuild()
 
     def rebuild(self):
-        with self._build_context(is_main_scene=True):
-            if self._scene_instance is None:
-                self._scene_instance = self.scene()
-            else:
-                self._scene_instance.build()
-
-            built_scene = Clear(
-                color=0xff000000,
-                child=self._scene_instance,
-            ).build_recursively()
-
-            size = built_scene.layout(Expr(0), Expr(0), var('width'), var('height'))
+        with self._build_lock:
+            self._build_number += 1
+            build_ids = BuildIds(self._build_number)
+            self._reply_handlers = {}
+            with self._build_context(is_main_scene=True), export('_build_ids', build_ids):
+                if self._scene_instance is None:
+                    self._scene_instance = self.scene()
+                else:
+                    self._scene_instance.build()
+                    # It's built again below, and the IDs are the ones given then, the same as on a first build
+                    build_ids.restart()
+                    self._reply_handlers.clear()
+
+                built_scene = Clear(
+                    color=0xff000000,
+                    child=self._scene_instance,
+                ).build_recursively()
+
+                size = built_scene.layout(Expr(0), Expr(0), var('width'), var('height'))
+
+            self._build_handlers.pop(build_ids.build, None)
+            self._build_handlers[build_ids.build] = self._reply_handlers
+            while len(self._build_handlers) > App.KEPT_BUILDS:
+                del self._build_handlers[next(iter(self._build_handlers))]
         oplist = Oplist()
         rendered_scene = built_scene.render(oplist, Expr(0), Expr(0), size[0], size[1])
 
@@ -79,11 +124,50 @@ class App:
 
         return {'oplist': oplist.to_list(), 'scene': rendered_scene, 'vars': variables}
 
-    def run(self):
-        self.server = ProtocolServer("/tmp/boldui.hello_world.sock", reply_handler=self._reply_handler)
-        self.server.scene = lambda: self.force_rebuild()
+    def run(self, idle_timeout=None):
+        """
+        With `idle_timeout` (seconds) the app exits when the user is away, after saving the model and the last scene.
+        Once socket activation starts it again, that scene is served right away while the real one is being built.
+        """
+        self.server = ProtocolServer("/tmp/boldui.hello_world.sock", reply_handler=self._reply_handler,
+                                     idle_timeout=idle_timeout, on_idle=self._on_idle)
+        snapshot = self.server.load_snapshot()
+        if snapshot is None:
+            self._handlers_ready.set()
+            self.server.scene = lambda: self.force_rebuild()
+        else:
+            self.server.scene = snapshot
+            threading.Thread(target=self._build_in_background, args=(snapshot,), daemon=True).start()
         self.server.serve()
 
+    def _build_in_background(self, snapshot):
+        # Under the number of the build that made the snapshot: if the tree is the same, it's the same scene and the
+        # client's replies to the snapshot find their handlers
+        snapshot_build = _scene_build(snapshot)
+        if snapshot_build is not None:
+            self._build_number = snapshot_build - 1
+        scene = self.rebuild()
+        if snapshot_build is not None and not patch.SceneSnapshot(scene).same_as(patch.SceneSnapshot(snapshot)):
+            # The tree changed while the app was away, the snapshot's IDs would reach other handlers
+            with self._build_lock:
+                del self._build_handlers[snapshot_build]
+            scene = self.rebuild()
+        with self._build_lock:
+            self._prebuilt_scene = scene
+        self._handlers_ready.set()
+        self.server.scene = self._take_prebuilt_scene
+
+    def _take_prebuilt_scene(self):
+        with self._build_lock:
+            if self._prebuilt_scene is not None:
+                scene, self._prebuilt_scene = self._prebuilt_scene, None
+                return scene
+        return self.force_rebuild()
+
+    def _on_idle(self):
+        if self.durable_model:
+            self.durable_model.sync()
+
     @contextlib.contextmanager
     def _build_context(self, is_main_scene=False):
         if self.durable_model is not None and not self._txn_active:
@@ -132,8 +216,14 @@ class App:
             self._txn_active = False
 
     def _reply_handler(self, reply_id, data_array):
-        with self._build_context():
-            self._reply_handlers[reply_id](data_array)
+        self._handlers_ready.wait()
+        with self._build_lock, self._build_context():
+            handler = self._build_handlers.get(BuildIds.build_of(reply_id), {}).get(reply_id)
+            if handler is None:
+                # From a scene more than KEPT_BUILDS builds old, or from before a restart that changed the tree
+                print('Ignoring reply to unknown handler', reply_id)
+                return
+            handler(data_array)
 
         if self._dirty:
             print('refreshing!')
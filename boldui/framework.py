@@ -21,6 +21,40 @@ def export(name, value):
         del Context[name]
 
 
+class BuildIds:
+    """
+    Gives out the reply / watch IDs of one build of the main scene: the build's number in the high bits, and the
+    widget's place in build order in the low ones (replies carry 32-bit IDs). Every build has its own IDs, so a reply
+    to an older scene still finds the handler of that build, while building the same tree under the same number gives
+    the same IDs, even in another process (see App._build_in_background).
+    """
+    BUILD_BITS = 12
+    ORDER_BITS = 20
+
+    def __init__(self, build_number):
+        # Wraps around, 0 is left out so IDs from raw ops (small numbers) don't pass for ours
+        self.build = (build_number - 1) % ((1 << BuildIds.BUILD_BITS) - 1) + 1
+        self._counts = {}
+
+    def next(self, kind):
+        count = self._counts.get(kind, 0) + 1
+        if count >> BuildIds.ORDER_BITS:
+            raise ValueError(f'More than {(1 << BuildIds.ORDER_BITS) - 1} {kind} IDs in one build')
+        self._counts[kind] = count
+        return self.build << BuildIds.ORDER_BITS | count
+
+    def restart(self):
+        self._counts.clear()
+
+    @staticmethod
+    def build_of(ident):
+        return ident >> BuildIds.ORDER_BITS
+
+
+def next_id(kind):
+    return Context['_build_ids'].next(kind)
+
+
 class Widget:
     BUILDS_CHILDREN = False
 
@@ -586,7 +620,6 @@ class Flexible(Widget):
 
 class EventHandler(Widget):
     BUILDS_CHILDREN = True
-    COUNTER = 1
 
     def __init__(self, child=None, on_mouse_down=None, on_scroll=None):
         self.child = child
@@ -597,8 +630,7 @@ class EventHandler(Widget):
             'Either on_mouse_down or on_scroll must be specified'
 
         self._built_child = None
-        self._id = EventHandler.COUNTER
-        EventHandler.COUNTER += 1
+        self._id = None
 
         super(EventHandler, self).__init__()
 
@@ -636,6 +668,7 @@ class EventHandler(Widget):
             return 1
 
     def build(self) -> Widget:
+        self._id = next_id('reply')
         if self.on_mouse_down:
             Context['_reply_handlers'][self._id] = self.on_mouse_down
         elif self.on_scroll:
@@ -701,7 +734,6 @@ class EventHandler(Widget):
 
 class WatchVar(Widget):
     BUILDS_CHILDREN = True
-    ACK_ID_COUNTER = 1
 
     def __init__(self, cond: Expr, data: List[Expr], handler=None, wait_for_roundtrip=True, wait_for_rebuild=False, child=None):
         self.cond = cond
@@ -712,11 +744,8 @@ class WatchVar(Widget):
         self.child = child
 
         self._built_child = None
-        self._hnd_id = EventHandler.COUNTER
-        EventHandler.COUNTER += 1
-
-        self._ack_id = WatchVar.ACK_ID_COUNTER
-        WatchVar.ACK_ID_COUNTER += 1
+        self._hnd_id = None
+        self._ack_id = None
 
         super(WatchVar, self).__init__()
 
@@ -738,11 +767,16 @@ class WatchVar(Widget):
             return 1
 
     def build(self) -> Widget:
+        self._hnd_id = next_id('reply')
+        self._ack_id = next_id('watch')
         if self.handler and not isinstance(self.handler, list):
+            # The ID of this build, a reply to an older scene acks the watch the client has from it
+            ack_id = self._ack_id
+
             def handler(value):
                 self.handler(value)
                 if self.wait_for_roundtrip and not self.wait_for_rebuild:
-                    Context['_app'].server.send_watch_ack(self._ack_id)
+                    Context['_app'].server.send_watch_ack(ack_id)
             Context['_reply_handlers'][self._hnd_id] = handler
 
         if self.child:
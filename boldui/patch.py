@@ -0,0 +1,125 @@
+"""
+Scene diffs for the SCENE_PATCH packet.
+
+A patch is a dict with these (optional) keys:
+    'oplist': {'length': new_length, 'replace': [[index, entry], ...], 'append': [entry, ...]}
+    'scene': [[start, end, [op, ...]], ...]  - splices on the old scene op list, in ascending order
+    'vars': new var definitions, same as in a full scene
+
+The client applies oplist replacements, truncates/extends to the new length, then applies the scene splices from
+last to first so earlier indices stay valid.
+"""
+import difflib
+import functools
+import json
+
+from boldui import wire
+
+# Above this many differing ops in the middle of the scene we don't bother with a proper diff, and just replace the
+# whole differing range (SequenceMatcher is quadratic in the worst case)
+MAX_SEQUENCE_MATCH = 2048
+
+_canonical = functools.partial(json.dumps, sort_keys=True, separators=(',', ':'))
+
+
+class SceneSnapshot:
+    """
+    The entries of a scene, to compare against the next one. Built scenes are never changed (sending one with var
+    values makes a copy), so the entries are shared instead of serialized, and compared by value.
+    """
+    def __init__(self, scene):
+        self.oplist = list(scene['oplist'])
+        self.scene = list(scene['scene'])
+        self.vars = scene.get('vars')
+        self._hash = None
+
+    def content_hash(self) -> bytes:
+        """
+        Same as wire.scene_hash() of the scene. Only needed for clients with scene caches, so computed on demand.
+        """
+        if self._hash is None:
+            self._hash = wire.scene_hash({'oplist': self.oplist, 'scene': self.scene, 'vars': self.vars})
+        return self._hash
+
+    def same_as(self, other) -> bool:
+        return len(self.oplist) == len(other.oplist) and _same(self.scene, other.scene) and \
+            _same(self.vars, other.vars) and not _changed_entries(self.oplist, other.oplist)
+
+
+def _same(a, b):
+    """
+    Like ==, but values of different types are never the same, at any depth. Scene ops and var definitions hold
+    constants of their own (colors, reply data, handler oplists...) where 1, 1.0 and True would otherwise be equal.
+    """
+    if type(a) is not type(b):
+        return False
+    if type(a) is dict:
+        return len(a) == len(b) and all(key in b and _same(value, b[key]) for key, value in a.items())
+    if type(a) is list:
+        return len(a) == len(b) and all(map(_same, a, b))
+    return a == b
+
+
+def _changed_entries(old, new):
+    """
+    Returns the indices below the length of the shorter oplist whose entries differ.
+    """
+    # Constants of different types can be equal (1 == 1.0 == True) but don't evaluate the same on the client. Entries
+    # that are expressions only hold indices and var names, so checking the top-level type is enough here.
+    return [i for i, (old_entry, new_entry) in enumerate(zip(old, new))
+            if old_entry != new_entry or type(old_entry) is not type(new_entry)]
+
+
+def _splices(old, new):
+    start = 0
+    end = min(len(old), len(new))
+    while start < end and _same(old[start], new[start]):
+        start += 1
+    suffix = 0
+    while suffix < end - start and _same(old[-1 - suffix], new[-1 - suffix]):
+        suffix += 1
+
+    old_end = len(old) - suffix
+    new_end = len(new) - suffix
+    if start == old_end and start == new_end:
+        return []
+
+    if old_end - start > MAX_SEQUENCE_MATCH or new_end - start > MAX_SEQUENCE_MATCH:
+        return [(start, old_end, start, new_end)]
+
+    # SequenceMatcher needs hashable items, only the part that differs is serialized (JSON keeps 1, 1.0 and true apart)
+    matcher = difflib.SequenceMatcher(None, [_canonical(op) for op in old[start:old_end]],
+                                      [_canonical(op) for op in new[start:new_end]], autojunk=False)
+    return [
+        (start + i1, start + i2, start + j1, start + j2)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != 'equal'
+    ]
+
+
+def diff(old: SceneSnapshot, new: SceneSnapshot, new_scene):
+    """
+    Returns (patch, changed_entries), an empty patch means the scenes are identical.
+    """
+    patch = {}
+    changed = 0
+
+    common = min(len(old.oplist), len(new.oplist))
+    replace = [[i, new_scene['oplist'][i]] for i in _changed_entries(old.oplist, new.oplist)]
+    append = new_scene['oplist'][common:]
+    if replace or append or len(old.oplist) != len(new.oplist):
+        patch['oplist'] = {'length': len(new.oplist), 'replace': replace, 'append': append}
+        changed += len(replace) + len(append)
+
+    splices = _splices(old.scene, new.scene)
+    if splices:
+        patch['scene'] = [[i1, i2, new_scene['scene'][j1:j2]] for i1, i2, j1, j2 in splices]
+        changed += sum(max(i2 - i1, j2 - j1) for i1, i2, j1, j2 in splices)
+
+    # Values pushed along with the scene must be re-applied even if they didn't change since the last scene, the client
+    # may have changed the var locally in the meantime
+    var_defs = new_scene.get('vars')
+    if not _same(old.vars, new.vars) or any(d.get('value') is not None for d in (var_defs or {}).values()):
+        patch['vars'] = var_defs
+
+    return patch, changed
@@ -95,6 +95,10 @@ class BaseModel:
         assert txn, 'Tried to commit, but no transaction in progress'
         txn.commit()
 
+    def sync(self):
+        db: lmdb.Environment = self.__dict__['_db']
+        db.sync(True)
+
     def abort_txn(self):
         txn: lmdb.Transaction = self.__dict__['_txn'][0]
         assert txn, 'Tried to abort, but no transaction in progress'
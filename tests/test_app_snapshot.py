@@ -0,0 +1,126 @@
+import json
+import socket
+
+import pytest
+
+from boldui import ProtocolServer, var
+from boldui.app import App
+from boldui.framework import Column, EventHandler, Rectangle, WatchVar, Widget
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    # Stands in for the socket systemd would pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(str(tmp_path / 'listen.sock'))
+
+    def make_app(page):
+        app = App(page)
+        app.server = ProtocolServer(str(tmp_path / 'app.sock'), reply_handler=app._reply_handler,
+                                    listen_fd=sock.fileno())
+        app._handlers_ready.set()
+        return app
+
+    yield make_app
+    sock.close()
+
+
+class Events:
+    def __init__(self, rows):
+        self.rows = rows
+        self.clicks = []
+        self.watched = []
+
+    def page(self):
+        events = self
+
+        class Page(Widget):
+            def build(self):
+                return Column([
+                    *(EventHandler(on_mouse_down=lambda data, row=row: events.clicks.append((row, data)),
+                                   child=Rectangle(color=0xff242424))
+                      for row in events.rows),
+                    WatchVar(cond=var('width') > 100, data=[var('width')], handler=events.watched.append,
+                             child=Rectangle(color=0xff00ff00)),
+                ])
+
+        return Page()
+
+
+def reply_ids(scene):
+    """
+    The reply IDs of the scene's handlers, one per row and then the watch's.
+    """
+    def visit(ops):
+        for op in ops:
+            if op.get('type') == 'reply':
+                yield op['id']
+            if isinstance(op.get('handler'), list):
+                yield from visit(op['handler'])
+    return list(visit(scene['scene']))
+
+
+def test_reply_after_restart_from_snapshot(make_app):
+    events = Events(['a', 'b'])
+
+    # The last scene of a process that rebuilt a few times before going idle
+    first = make_app(events.page)
+    for _ in range(3):
+        snapshot = first.rebuild()
+    snapshot = json.loads(json.dumps(snapshot))
+
+    # Its replacement serves the snapshot while building, the client keeps replying to the snapshot's handlers
+    restarted = make_app(events.page)
+    restarted._handlers_ready.clear()
+    restarted.server.scene = snapshot
+    restarted._build_in_background(snapshot)
+
+    assert json.loads(json.dumps(restarted.server.scene)) == snapshot
+    _, click_b, watch = reply_ids(snapshot)
+    restarted._reply_handler(click_b, [1, 2, 3])
+    restarted._reply_handler(watch, [200])
+    assert events.clicks == [('b', [1, 2, 3])]
+    assert events.watched == [[200]]
+
+
+def test_restart_with_another_tree_ignores_snapshot_replies(make_app):
+    snapshot = json.loads(json.dumps(make_app(Events(['a', 'b']).page).rebuild()))
+
+    events = Events(['x', 'a', 'b'])
+    restarted = make_app(events.page)
+    restarted._build_in_background(snapshot)
+
+    # The first row's ID would now be x's, it mustn't be taken for a click on it
+    restarted._reply_handler(reply_ids(snapshot)[0], [1, 2, 3])
+    assert events.clicks == []
+    restarted._reply_handler(reply_ids(restarted.server.scene)[0], [4, 5, 6])
+    assert events.clicks == [('x', [4, 5, 6])]
+
+
+def test_reply_to_previous_build_after_tree_changed(make_app):
+    events = Events(['a', 'b'])
+    app = make_app(events.page)
+    old_click_a, old_click_b, old_watch = reply_ids(app.rebuild())
+
+    # A row is added in front, the client replies to the scene it has before the new one gets there
+    events.rows.insert(0, 'x')
+    new_ids = reply_ids(app.rebuild())
+    assert not set(new_ids) & {old_click_a, old_click_b, old_watch}
+
+    app._reply_handler(old_click_a, [1, 2, 3])
+    app._reply_handler(old_watch, [200])
+    app._reply_handler(new_ids[0], [4, 5, 6])
+    assert events.clicks == [('a', [1, 2, 3]), ('x', [4, 5, 6])]
+    assert events.watched == [[200]]
+
+
+def test_reply_to_unknown_handler_is_ignored(make_app):
+    events = Events(['a'])
+    app = make_app(events.page)
+    too_old = reply_ids(app.rebuild())[0]
+    for _ in range(App.KEPT_BUILDS):
+        app.rebuild()
+
+    app._reply_handler(too_old, [1, 2, 3])
+    app._reply_handler(1000, [1, 2, 3])
+    assert events.clicks == []
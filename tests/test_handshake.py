@@ -0,0 +1,31 @@
+import json
+import socket
+import threading
+
+from boldui import Ops, ProtocolServer, wire
+
+
+def test_client_from_before_version_2_gets_json(tmp_path):
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(tmp_path / 'listen.sock'))
+    # Like the one systemd passes
+    listener.listen()
+    server = ProtocolServer(str(tmp_path / 'app.sock'), listen_fd=listener.fileno())
+    server.scene = {'oplist': [], 'scene': [Ops.clear(0xff242424)], 'vars': {}}
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+
+    # Such clients assert the header is exactly this
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(str(tmp_path / 'listen.sock'))
+    client.settimeout(5)
+    assert wire.recv_exactly(client, 8) == b'BoldUI\x00\x01'
+    client.sendall(b'BoldUI\x00\x01')
+
+    packet = wire.PacketReader(client).read_packet()
+    assert int.from_bytes(packet[:4], 'big') == 0
+    assert json.loads(bytes(packet[4:]))['scene'] == [{'type': 'clear', 'color': 0xff242424}]
+
+    client.close()
+    thread.join(5)
+    listener.close()
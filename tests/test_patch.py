@@ -0,0 +1,45 @@
+import copy
+
+import pytest
+
+from boldui import Ops, patch
+
+
+def make_scene():
+    return {
+        'oplist': [0, 10, 20, 0xff242424, {'type': 'var', 'name': 'width'}],
+        'scene': [
+            Ops.clear(0xff000000),
+            Ops.rect([0, 0, 1, 2], 3),
+            Ops.event_handler([0, 0, 1, 2], 1, [Ops.set_var('width', 0)], [0]),
+            Ops.watch_var(7, 0, False, [Ops.reply(8, [4])]),
+        ],
+        'vars': {'width': {'type': 'int', 'default': 100}},
+    }
+
+
+@pytest.mark.parametrize('change', [
+    lambda scene: scene['scene'][0].update(color=float(0xff000000)),
+    lambda scene: scene['scene'][2]['oplist'].__setitem__(0, 0.0),
+    lambda scene: scene['scene'][2]['oplist'].__setitem__(0, False),
+    lambda scene: scene['scene'][3].update(waitForRoundtrip=0),
+    lambda scene: scene['scene'][3]['handler'][0].update(id=8.0),
+    lambda scene: scene['vars']['width'].update(default=100.0),
+])
+def test_equal_constants_of_another_type_are_a_change(change):
+    old = make_scene()
+    new = copy.deepcopy(old)
+    change(new)
+    old_snapshot, new_snapshot = patch.SceneSnapshot(old), patch.SceneSnapshot(new)
+
+    assert not old_snapshot.same_as(new_snapshot)
+    diff, _ = patch.diff(old_snapshot, new_snapshot, new)
+    assert diff
+
+
+def test_identical_scenes_have_an_empty_patch():
+    old, new = make_scene(), make_scene()
+    old_snapshot, new_snapshot = patch.SceneSnapshot(old), patch.SceneSnapshot(new)
+
+    assert old_snapshot.same_as(new_snapshot)
+    assert patch.diff(old_snapshot, new_snapshot, new) == ({}, 0)
@@ -0,0 +1,15 @@
+import pytest
+
+from boldui import wire
+
+
+@pytest.mark.parametrize('value', [
+    {'type': ['rect'], 'rect': [0, 1, 2, 3]},
+    {'type': {'nested': True}},
+    {'type': None, 'color': 1},
+    {'type': 1.5},
+])
+def test_dicts_with_non_string_type_round_trip(value):
+    assert wire.decode(wire.encode(value)) == value
+    assert wire.decode(wire.encode([value, {'type': 'rect', 'rect': [0, 1, 2, 3], 'color': 4}])) == \
+        [value, {'type': 'rect', 'rect': [0, 1, 2, 3], 'color': 4}]
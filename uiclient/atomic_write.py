@@ -0,0 +1,18 @@
+import os
+import tempfile
+
+
+def atomic_write(path, data):
+    """
+    Replaces the file at path with data (str or bytes), written to a temp file next to it first so nobody ever sees
+    half of it, even if we crash mid-write. Raises OSError.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{name}-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
@@ -0,0 +1,55 @@
+"""
+Uniform grid of the event handlers' rects, so finding the handlers under the pointer doesn't go through every handler
+of the scene (virtualized lists have thousands).
+"""
+import math
+
+CELL_SIZE = 64
+# Handlers covering more cells than this (backgrounds, scroll areas) are checked for every point instead of being added
+# to each of their cells
+MAX_HANDLER_CELLS = 64
+
+
+class HitGrid:
+    def __init__(self, handlers, width, height):
+        self.handlers = handlers
+        self._width = width
+        self._height = height
+        self._columns = max(1, math.ceil(width / CELL_SIZE))
+        self._rows = max(1, math.ceil(height / CELL_SIZE))
+        # Indices in self.handlers, in scene order
+        self._cells = [[] for _ in range(self._columns * self._rows)]
+        self._big = []
+
+        for i, handler in enumerate(handlers):
+            left, top, right, bottom = handler['rect']
+            # Also false for NaNs, such a rect can't be hit. Rects outside the window only matter for points outside
+            # of it, which aren't looked up in the grid
+            if not (left <= right and top <= bottom and right >= 0 and bottom >= 0 and left < width and top < height):
+                continue
+            first_column, last_column = int(max(left, 0) // CELL_SIZE), int(min(right, width - 1) // CELL_SIZE)
+            first_row, last_row = int(max(top, 0) // CELL_SIZE), int(min(bottom, height - 1) // CELL_SIZE)
+            if (last_column - first_column + 1) * (last_row - first_row + 1) > MAX_HANDLER_CELLS:
+                self._big.append(i)
+                continue
+            for row in range(first_row, last_row + 1):
+                for cell in self._cells[row * self._columns + first_column:row * self._columns + last_column + 1]:
+                    cell.append(i)
+
+    def query(self, x, y):
+        """
+        Returns the handlers whose rect contains (x, y), in scene order (the topmost one last).
+        """
+        if 0 <= x < self._width and 0 <= y < self._height:
+            candidates = self._cells[int(y // CELL_SIZE) * self._columns + int(x // CELL_SIZE)]
+            if self._big:
+                candidates = sorted(candidates + self._big)
+        else:
+            candidates = range(len(self.handlers))
+
+        hits = []
+        for i in candidates:
+            left, top, right, bottom = self.handlers[i]['rect']
+            if left <= x <= right and top <= y <= bottom:
+                hits.append(self.handlers[i])
+        return hits
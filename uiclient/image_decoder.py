@@ -0,0 +1,114 @@
+"""
+Decodes images for UIClient in worker processes. skia keeps the GIL while decoding, so a decoding thread would still
+stall the render thread for as long as a big photo takes to decode. Images are scaled down in the workers to the size
+bucket they're drawn at (the next power of two of the destination rect), so only the pixels needed are sent back.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+
+import skia
+
+MIN_BUCKET = 64
+# Images drawn bigger than this are kept at full resolution
+MAX_BUCKET = 16384
+WORKERS = min(4, os.cpu_count() or 1)
+# Images asked for while this many are being decoded wait for the next frame, which comes when one is done. Spares
+# queueing a whole gallery in one frame, and images that went away before their turn are never decoded
+MAX_PENDING = 2 * WORKERS
+
+_SAMPLING = skia.SamplingOptions(skia.FilterMode.kLinear, skia.MipmapMode.kLinear)
+
+
+def size_bucket(rect):
+    size = max(abs(rect[2] - rect[0]), abs(rect[3] - rect[1]))
+    bucket = MIN_BUCKET
+    while bucket < size and bucket < MAX_BUCKET:
+        bucket *= 2
+    return bucket
+
+
+def _decode(uri, bucket):
+    # Runs in the workers
+    # The codec reads from data without keeping a reference to it
+    data = skia.Data.MakeFromFileName(uri)
+    if data is None:
+        raise FileNotFoundError(uri)
+    codec = skia.Codec.MakeFromData(data)
+    size = codec.dimensions()
+    scale = min(1, bucket / max(size.width(), size.height()))
+    # JPEGs can be decoded straight to 1/2, 1/4 or 1/8 of their size, which is much faster than decoding the whole
+    # image and scaling it down
+    info = skia.ImageInfo.MakeN32Premul(codec.getScaledDimensions(scale))
+    pixels = bytearray(info.computeMinByteSize())
+    result = codec.getPixels(info, pixels, info.minRowBytes())
+    if result not in (skia.Codec.kSuccess, skia.Codec.kIncompleteInput):
+        raise ValueError(skia.Codec.ResultToString(result))
+    image = skia.Image.frombytes(pixels, info.dimensions(), info.colorType(), info.alphaType())
+
+    if scale < 1 and max(image.width(), image.height()) > bucket:
+        width, height = max(1, round(size.width() * scale)), max(1, round(size.height() * scale))
+        image = image.resize(width, height, _SAMPLING)
+    image = image.convert(colorType=skia.kRGBA_8888_ColorType, alphaType=skia.kUnpremul_AlphaType)
+    return image.tobytes(), image.width(), image.height()
+
+
+class ImageDecoder:
+    """
+    Calls on_decoded((uri, bucket), image) from another thread once an image is ready, with None for an image that
+    couldn't be decoded.
+    """
+    def __init__(self, on_decoded):
+        self._on_decoded = on_decoded
+        # Started with the first image
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the workers, which takes a while, ahead of the first image (from any thread).
+        """
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        if self._executor is None:
+            # Not forked, the client has its SDL and protocol threads running
+            self._executor = ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            # Workers are started with the jobs, not with the executor
+            for _ in range(WORKERS):
+                self._executor.submit(int)
+
+    def decode(self, uri, bucket):
+        key = (uri, bucket)
+        with self._lock:
+            if key in self._pending or len(self._pending) >= MAX_PENDING:
+                return
+            self._start()
+            try:
+                future = self._executor.submit(_decode, uri, bucket)
+            except BrokenExecutor:
+                # A worker died (out of memory on a huge image?), start over with the next frame
+                self._executor = None
+                return
+            self._pending.add(key)
+        future.add_done_callback(lambda done: self._done(key, done))
+
+    def _done(self, key, future):
+        try:
+            pixels, width, height = future.result()
+            image = skia.Image.frombytes(pixels, (width, height), skia.kRGBA_8888_ColorType,
+                                         skia.kUnpremul_AlphaType)
+        except BrokenExecutor:
+            # Not this image's fault, decoded again the next time it's drawn
+            with self._lock:
+                self._pending.discard(key)
+            return
+        except Exception as e:
+            print('Failed to decode', key[0], repr(e))
+            image = None
+        with self._lock:
+            self._pending.discard(key)
+        self._on_decoded(key, image)
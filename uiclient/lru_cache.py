@@ -0,0 +1,58 @@
+"""
+Least recently used cache with budgets in entries and in bytes, for the client's text, font and image caches which
+would otherwise grow for as long as the client runs (a live log measures every line it ever showed).
+"""
+import collections
+import threading
+
+
+class LRUCache:
+    def __init__(self, max_entries=None, max_bytes=None):
+        # None for no limit
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Sum of the sizes given to put
+        self.nbytes = 0
+        # hits, misses, evictions
+        self.stats = collections.Counter()
+        # key: (value, size)
+        self._entries = collections.OrderedDict()
+        # Text is measured by both the UI thread and the protocol thread (watches, var updates)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0]
+
+    def put(self, key, value, size=0):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous[1]
+            self._entries[key] = (value, size)
+            self.nbytes += size
+
+            # The newest entry always stays, even when it's bigger than the whole budget, it's about to be used
+            while len(self._entries) > 1 and (
+                    (self.max_entries is not None and len(self._entries) > self.max_entries) or
+                    (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
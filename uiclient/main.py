@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
+import argparse
+import collections
 import json
 import math
 import socket
-import struct
 import sys
 import threading
 import time
@@ -10,7 +11,18 @@ from typing import Tuple, Dict
 
 import skia
 
+import wire
 from main_loop import main_loop
+from oplist_compiler import CompiledOplist, HandlerOplist
+from picture_cache import find_runs
+from lru_cache import LRUCache
+from image_decoder import ImageDecoder, size_bucket
+from hit_grid import HitGrid
+from watch_index import WatchIndex
+from scene_recorder import SceneRecorder
+from profiler import Profiler
+import oplist_vectorized
+from scene_cache import SceneCache
 
 
 class Actions:
@@ -18,45 +30,152 @@ class Actions:
     HANDLER_REPLY = 1
     SET_VAR = 2
     WATCH_ACK = 3
+    SCENE_PATCH = 4
+    SCENE_UNCHANGED = 5
+    SHUTDOWN = 6
 
 
 class Protocol:
-    def __init__(self, address, ui_client):
+    COMPRESSION_FEATURES = {
+        'none': 0,
+        'zlib': wire.FEATURE_ZLIB,
+        # Falls back to zlib when either end doesn't have zstandard
+        'zstd': wire.FEATURE_ZSTD | wire.FEATURE_ZLIB,
+    }
+
+    def __init__(self, address, ui_client, compression='none'):
         self.address = address
         self.ui_client = ui_client
+        self.compression = compression
 
         self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.version = None
+        self.features = 0
+        self.binary = False
+        self._decompressor = None
+        # bytes_received: bytes read from the socket (including framing), bytes_decompressed: size of the
+        # compressed payloads after decompressing, decompress_time: seconds spent decompressing
+        self.stats = collections.Counter()
+        self._reader = wire.PacketReader(self.socket)
+        # Both the UI thread and the protocol thread send replies
+        self._send_lock = threading.Lock()
+        self.connected = False
         self.thread = threading.Thread(target=self._loop, daemon=True)
 
     def connect(self):
         self.socket.connect(self.address)
+        # The handshake waits for the server to be up, which may take a while, meanwhile the cached scene is shown
+        self.thread.start()
 
-        server_header = self.socket.recv(8)
-        assert server_header == b'BoldUI\x00\x01'
-        self.socket.send(b'BoldUI\x00\x01')
+    def _handshake(self):
+        # Servers advertise version 1, the only one clients from before version 2 accept, and take any version they
+        # know from us. Those from before version 2 hang up on anything but 1 though, so try again with that.
+        if not self._try_handshake(wire.PROTOCOL_LATEST):
+            print('Server only speaks protocol version 1, reconnecting')
+            self.socket.close()
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._reader = wire.PacketReader(self.socket)
+            self.socket.connect(self.address)
+            self._try_handshake(wire.PROTOCOL_JSON)
 
-        self.thread.start()
+        self.binary = wire.binary_payloads(self.version, self.features)
+        with self._send_lock:
+            self.connected = True
+
+    def _try_handshake(self, version) -> bool:
+        """
+        Returns False if the server hung up on that version.
+        """
+        server_header = wire.recv_exactly(self.socket, 8)
+        assert len(server_header) == 8 and server_header[:7] == wire.PROTOCOL_MAGIC
+        self.version = version
+        self.socket.sendall(wire.PROTOCOL_MAGIC + bytes([self.version]))
+
+        if self.version >= wire.PROTOCOL_FEATURES:
+            server_features = wire.recv_exactly(self.socket, 4)
+            if len(server_features) < 4:
+                return False
+            server_features = int.from_bytes(server_features, 'big')
+            usable = Protocol.COMPRESSION_FEATURES[self.compression] & server_features & wire.SUPPORTED_FEATURES
+            for feature in (wire.FEATURE_ZSTD, wire.FEATURE_ZLIB):
+                if usable & feature:
+                    self.features = feature
+                    self._decompressor = wire.Decompressor(feature)
+                    break
+            # Smaller but slower to decode than JSON, only worth it on the slow links compression is for
+            if self.features and server_features & wire.FEATURE_BINARY:
+                self.features |= wire.FEATURE_BINARY
+
+            cached_hash = self.ui_client.cached_scene_hash
+            if (self.ui_client.scene_cache or cached_hash) and server_features & wire.FEATURE_SCENE_HASH:
+                self.features |= wire.FEATURE_SCENE_HASH
+                cached_hash = cached_hash or bytes(wire.SCENE_HASH_SIZE)
+                self.socket.sendall(self.features.to_bytes(4, 'big') + cached_hash)
+            else:
+                self.socket.sendall(self.features.to_bytes(4, 'big'))
+        return True
 
     def _loop(self):
+        self._handshake()
         while True:
-            packet = b''
-            packet_length = self.socket.recv(4)
-            if not packet_length:
+            packet = self._reader.read_packet()
+            if packet is None:
                 break
-
-            packet_length = int.from_bytes(packet_length, 'big')
-            while len(packet) < packet_length:
-                packet += self.socket.recv(packet_length - len(packet))
+            self.stats['bytes_received'] += 4 + len(packet)
 
             self._handle_packet(packet)
 
-    def send_packet(self, packet):
-        # print('Sending packet:', packet)
-        self.socket.send(len(packet).to_bytes(4, 'big') + packet)
+        with self._send_lock:
+            self.connected = False
+        # Keep what we have, the next launch (or the restarted server) can start from it
+        self.ui_client.save_scene_cache()
+
+    def _decode(self, payload):
+        if self.binary:
+            return wire.decode(payload)
+        return json.loads(str(payload, 'utf-8'))
+
+    @staticmethod
+    def _apply_patch(scene, patch):
+        """
+        Returns the patched scene, a new one: the scene being drawn must not change under the render thread.
+        """
+        scene = {**scene, 'oplist': list(scene['oplist']), 'scene': list(scene['scene'])}
+        if 'oplist' in patch:
+            oplist = scene['oplist']
+            for index, entry in patch['oplist']['replace']:
+                oplist[index] = entry
+            del oplist[patch['oplist']['length']:]
+            oplist += patch['oplist']['append']
+
+        # Splices are sorted, apply from the end so the earlier ranges stay valid
+        for start, end, ops in reversed(patch.get('scene', [])):
+            scene['scene'][start:end] = ops
+
+        if 'vars' in patch:
+            scene['vars'] = patch['vars']
+        return scene
+
+    def send_packet(self, *parts):
+        # print('Sending packet:', parts)
+        with self._send_lock:
+            # Anything done on the cached scene before the handshake completes is dropped, the server will send the
+            # current one right after
+            if self.connected:
+                wire.send_packet(self.socket, *parts)
 
     def _handle_packet(self, packet):
+        profiler = self.ui_client.profiler
+        if profiler is not None:
+            profile_start = profiler.now()
         packet_type = int.from_bytes(packet[:4], 'big')
         packet = packet[4:]
+        if packet_type & wire.COMPRESSED:
+            start = time.perf_counter()
+            packet = memoryview(self._decompressor.decompress(packet))
+            self.stats['decompress_time'] += time.perf_counter() - start
+            self.stats['bytes_decompressed'] += len(packet)
+            packet_type &= ~wire.COMPRESSED
 
         def process_var_defs(defs):
             print('process_var_defs: defs:', defs)
@@ -90,22 +209,47 @@ class Protocol:
                 self.ui_client.persistent_context[v] = new_value
                 print(f'{v} = {new_value}')
 
+            self.ui_client.request_redraw()
             self.ui_client._should_update_watches = True
             self.ui_client.update_watches(send=True)
 
-        if packet_type == Actions.UPDATE_SCENE:
-            open('scene.json', 'wb').write(packet)
-
-            self.ui_client.scene = json.loads(packet)
-            if 'vars' in self.ui_client.scene:
-                process_var_defs(self.ui_client.scene['vars'])
+        def scene_updated(var_defs):
+            self.ui_client.has_scene = True
+            if self.ui_client.scene_recorder:
+                self.ui_client.scene_recorder.record(self.ui_client.scene)
+            if var_defs is not None:
+                process_var_defs(var_defs)
+                self.ui_client.request_redraw()
 
             self.ui_client._blocked_watches.clear()
             self.ui_client._should_update_watches = True
             self.ui_client.update_watches(send=True)
+
+        if packet_type == Actions.UPDATE_SCENE:
+            scene = self._decode(packet)
+            if profiler is not None:
+                profiler.span('decode', profile_start, bytes=len(packet))
+                profile_start = profiler.now()
+            self.ui_client.scene = scene
+            if profiler is not None:
+                profiler.span('load scene', profile_start)
+            scene_updated(scene.get('vars'))
+        elif packet_type == Actions.SCENE_PATCH:
+            patch = self._decode(packet)
+            scene = Protocol._apply_patch(self.ui_client.scene, patch)
+            if profiler is not None:
+                profiler.span('decode', profile_start, bytes=len(packet))
+                profile_start = profiler.now()
+            self.ui_client.scene = scene
+            if profiler is not None:
+                profiler.span('load scene', profile_start)
+            scene_updated(patch.get('vars'))
+        elif packet_type == Actions.SCENE_UNCHANGED:
+            # The scene we loaded from the cache is the current one
+            scene_updated(self.ui_client.scene.get('vars'))
         elif packet_type == Actions.SET_VAR:
             if packet:
-                parts = packet.split(b'\x00')
+                parts = bytes(packet).split(b'\x00')
                 var_updates = {}
                 while parts:
                     key, value = parts[:2]
@@ -116,34 +260,203 @@ class Protocol:
             ack_id = int.from_bytes(packet[:8], 'big')
             # print(f'Watch ack #{ack_id}')
             self.ui_client.ack_watch(ack_id)
+        elif packet_type == Actions.SHUTDOWN:
+            # Idle server exiting, keep showing the scene and start it again once the window is focused
+            print('Server went idle')
+            self.ui_client.server_idle = True
         else:
-            print('[client] Unknown packet type:', packet)
+            print('[client] Unknown packet type:', bytes(packet))
+
+
+class LoadedScene:
+    """
+    A scene with everything made from it to draw it and check its watches. Scenes from the server are loaded on the
+    protocol thread, and UIClient.draw swaps to the latest one at the start of a frame.
+    """
+    def __init__(self, scene, evaluator):
+        self.scene = scene
+        self.evaluate_oplist = evaluator(scene['oplist'], UIClient.measure_text)
+        self.picture_runs = {}
+        if UIClient.USE_PICTURES:
+            self.picture_runs = find_runs(scene['scene'], self.evaluate_oplist.dependencies)
+        self.watch_index = WatchIndex(scene['scene'], scene['oplist'], UIClient.measure_text)
+        # Scenes reading `time` have to be drawn every frame, others only change with input, vars or a new scene
+        self.animated = any(isinstance(op, dict) and op.get('type') == 'var' and op.get('name') == 'time'
+                            for op in scene['oplist'])
+        self.has_images = any(item['type'] == 'image' for item in scene['scene'])
+
+
+class EventContext:
+    """
+    The context handler oplists are evaluated with: the event's vars, then the client's, without copying them for every
+    event.
+    """
+    _MISSING = object()
+
+    def __init__(self, event_vars, client_vars):
+        self._event_vars = event_vars
+        self._client_vars = client_vars
+
+    def get(self, name, default=None):
+        value = self._event_vars.get(name, EventContext._MISSING)
+        if value is EventContext._MISSING:
+            return self._client_vars.get(name, default)
+        return value
 
 
 class UIClient:
     WATCH_RECURSION = 3
-    _text_measurement_cache = {}
-    _font_cache = {}
+    # Budgets can be changed on the caches (max_entries, max_bytes), which count hits, misses and evictions in stats
+    _text_measurement_cache = LRUCache(max_entries=100000, max_bytes=32 * 1024 * 1024)
+    _font_cache = LRUCache(max_entries=256)
+    # Rough size of a text measurement cache entry besides its key (the measurement and the cache's bookkeeping)
+    TEXT_MEASUREMENT_ENTRY_SIZE = 200
+    # Frames with damage bigger than this part of the window are painted in full
+    FULL_REDRAW_DAMAGE = 0.5
+    # Pixels around an item's rect that antialiasing may touch
+    DAMAGE_PADDING = 2
+    # Record runs of items that don't change every frame into skia.Pictures, see picture_cache.py
+    USE_PICTURES = True
+    # Paints (by color) and text blobs (by font and text) kept between frames, the paint pool starts over when full
+    DRAW_POOL_SIZE = 4096
+    # Decoded images, in bytes of pixels
+    IMAGE_CACHE_BYTES = 256 * 1024 * 1024
+    # Drawn where an image is while it's being decoded
+    IMAGE_PLACEHOLDER_COLOR = 0x20808080
+
+    EVALUATORS = {
+        'compiled': CompiledOplist,
+        'numpy': oplist_vectorized.VectorizedOplist,
+    }
 
-    def __init__(self, address):
+    def __init__(self, address, compression='none', use_scene_cache=True, evaluator='compiled', topmost_events=False,
+                 record_scenes=None, profile=None):
+        self.address = address
+        self.compression = compression
+        self.evaluator = UIClient.EVALUATORS[evaluator]
+        # Only the topmost handler under the pointer gets an event, instead of all of them
+        self.topmost_events = topmost_events
+        # Set by main_loop, wakes it up from any thread
+        self.wake_main_loop = None
+        self._redraw_requested = True
+        # By (uri, size bucket), see image_decoder.py
+        self.image_cache = LRUCache(max_bytes=UIClient.IMAGE_CACHE_BYTES)
+        self._image_decoder = ImageDecoder(self._image_decoded)
+        self._failed_images = set()
+        # Path to write the scenes from the server to, see scene_recorder.py
+        self.scene_recorder = SceneRecorder(record_scenes) if record_scenes else None
+        # Path to write the Chrome trace of the latest frames to, see profiler.py
+        self.profiler = Profiler(profile) if profile else None
+        # The one being drawn, the latest one replaces it at the start of the next frame
+        self._shown_scene = None
         self.scene = {
             'oplist': [0xff202020],
             'scene': [
                 {'type': 'clear', 'color': 0},
             ]
         }
-        self.event_handlers = []
-        self.protocol = Protocol(address, self)
         self.persistent_context = {}
+        self.cached_scene_hash = None
+        # False while showing the placeholder
+        self.has_scene = False
+        self.scene_cache = SceneCache(address) if use_scene_cache else None
+        cached = self.scene_cache and self.scene_cache.load()
+        if cached:
+            # Shown until the server answers, which is usually with "unchanged" or a small patch
+            self.scene, self.persistent_context = cached
+            self.cached_scene_hash = wire.scene_hash(self.scene)
+            self.has_scene = True
+        self._show_latest_scene()
+
+        self.event_handlers = []
+        # Index of event_handlers, made with the first event after a frame
+        self._hit_grid = None
+        # [x, y, scroll_x, scroll_y] of the wheel events not dispatched yet, and replies not sent yet (see flush_input)
+        self._pending_scroll = None
+        self._pending_replies = []
+        # The protocol thread queues the replies of watches too
+        self._replies_lock = threading.Lock()
+        # wheel_events, scroll_dispatches, reply_packets, replies
+        self.input_stats = collections.Counter()
+        self.server_idle = False
+        self.protocol = Protocol(address, self, compression)
         self._should_update_watches = False
         self._blocked_watches = set()
         self.width = 0
         self.height = 0
-        self.image_cache = {}
+        self._drawn_items = None
+        # Frames painted in full, partly and not at all, and skia objects made by the draw path
+        self.draw_stats = collections.Counter()
+        self._paints = {}
+        self._text_blobs = LRUCache(max_entries=UIClient.DRAW_POOL_SIZE)
+        # Skia copies rects when drawing, so the same ones are filled in for each item
+        self._rect = skia.Rect()
+        self._rrect = skia.RRect()
         self._start_time = time.time()
 
         self.protocol.connect()
 
+    @property
+    def scene(self):
+        """
+        The latest scene, which may not be drawn yet. Scenes mustn't be changed once set, patches make new ones.
+        """
+        return self._latest_scene.scene
+
+    @scene.setter
+    def scene(self, value):
+        # Compiled and indexed on the calling thread, a single assignment hands it to the render thread
+        self._latest_scene = LoadedScene(value, self.evaluator)
+        if self._latest_scene.has_images:
+            self._image_decoder.start()
+        self.request_redraw()
+
+    def _show_latest_scene(self):
+        """
+        Makes the latest scene the one drawn, between frames (on the render thread).
+        """
+        loaded = self._latest_scene
+        if loaded is self._shown_scene:
+            return
+        self._shown_scene = loaded
+        self._scene = loaded.scene
+        self.evaluate_oplist = loaded.evaluate_oplist
+        self._picture_runs = loaded.picture_runs
+        self.animated = loaded.animated
+        # id(evtHnd item): (item, HandlerOplist), made with the handler's first event in the scene
+        self._handler_oplists = {}
+
+    def request_redraw(self):
+        self._redraw_requested = True
+        if self.wake_main_loop is not None:
+            self.wake_main_loop()
+
+    def take_redraw_request(self) -> bool:
+        requested = self._redraw_requested
+        self._redraw_requested = False
+        return requested
+
+    def wake_server(self):
+        """
+        Reconnects to a server that shut down for being idle, socket activation starts it again.
+        """
+        if not self.server_idle or self.protocol.thread.is_alive():
+            return
+
+        # It serves the scene it had before going away, which is what we have
+        self.cached_scene_hash = wire.scene_hash(self.scene) if self.has_scene else None
+        self.protocol = Protocol(self.address, self, self.compression)
+        try:
+            self.protocol.connect()
+        except OSError as e:
+            print('Failed to wake the server up', e)
+            return
+        self.server_idle = False
+
+    def save_scene_cache(self):
+        if self.scene_cache and self.has_scene:
+            self.scene_cache.save(self.scene, dict(self.persistent_context))
+
     @staticmethod
     def _paint_from_int_color(color):
         return skia.Paint(
@@ -156,33 +469,63 @@ class UIClient:
             AntiAlias=True,
         )
 
+    def _paint(self, color):
+        paint = self._paints.get(color)
+        if paint is None:
+            if len(self._paints) >= UIClient.DRAW_POOL_SIZE:
+                self._paints.clear()
+            paint = self._paints[color] = self._paint_from_int_color(color)
+            self.draw_stats['paints_created'] += 1
+        return paint
+
+    def _text_blob(self, font_name, font_size, text):
+        """
+        Returns the shaped text (None for an empty string), its width and its ink bounds relative to the origin.
+        """
+        key = (font_name, font_size, text)
+        text_blob = self._text_blobs.get(key)
+        if text_blob is None:
+            font = UIClient.get_font(font_name, font_size)
+            ink = skia.Rect()
+            width = font.measureText(text, skia.TextEncoding.kUTF8, ink, self._paint(0xffffffff))
+            blob = skia.TextBlob.MakeFromString(text, font)
+            text_blob = (blob, width, (ink.left(), ink.top(), ink.right(), ink.bottom()))
+            self._text_blobs.put(key, text_blob)
+            self.draw_stats['text_blobs_created'] += 1
+        return text_blob
+
     @staticmethod
     def measure_text(text, font_size) -> (float, float):
         font_name = 'Cantarell'
         key = f'{font_name}:{font_size}:{text}'
 
-        if key in UIClient._text_measurement_cache:
-            return UIClient._text_measurement_cache[key]
+        measurement = UIClient._text_measurement_cache.get(key)
+        if measurement is not None:
+            return measurement
 
         # print('measure text cache miss')
         paint = UIClient._paint_from_int_color(0xffffffff)
         font = UIClient.get_font(font_name, font_size)
         bounds = skia.Rect()
         font.measureText(text, skia.TextEncoding.kUTF8, bounds, paint)
-        UIClient._text_measurement_cache[key] = (bounds.width(), font_size)
+        measurement = (bounds.width(), font_size)
+        entry_size = sys.getsizeof(key) + UIClient.TEXT_MEASUREMENT_ENTRY_SIZE
+        UIClient._text_measurement_cache.put(key, measurement, entry_size)
 
-        return UIClient._text_measurement_cache[key]
+        return measurement
 
     @staticmethod
     def get_font(font_name, font_size):
         key = f'{font_name}:{font_size}'
 
-        if key in UIClient._font_cache:
-            return UIClient._font_cache[key]
+        font = UIClient._font_cache.get(key)
+        if font is not None:
+            return font
 
         print('font cache miss')
-        UIClient._font_cache[key] = skia.Font(skia.Typeface(font_name), font_size)
-        return UIClient._font_cache[key]
+        font = skia.Font(skia.Typeface(font_name), font_size)
+        UIClient._font_cache.put(key, font)
+        return font
 
     @staticmethod
     def resolve_op(value, op_results, context):
@@ -292,166 +635,397 @@ class UIClient:
     def resize(self, width, height):
         self.width = width
         self.height = height
+        self.invalidate()
+        self.request_redraw()
         self._should_update_watches = True
         self.update_watches(send=True)
 
+    def invalidate(self):
+        """
+        Makes the next draw() paint everything, for when the canvas doesn't hold the previous frame anymore.
+        """
+        self._drawn_items = None
+        for run in self._picture_runs.values():
+            run.values = None
+            run.item = None
+
     def draw(self, canvas: skia.Canvas) -> None:
+        """
+        Only paints again the parts of the canvas where something changed since the last frame drawn on it, the rest
+        of the previous frame must still be there (see invalidate).
+        """
+        profiler = self.profiler
+        if profiler is not None:
+            start = profiler.now()
+        self._show_latest_scene()
         context = self.context
+        op_results = self.evaluate_oplist(context)
+        if profiler is not None:
+            profiler.span('evaluate oplist', start, evaluated=self.evaluate_oplist.last_evaluated)
+            start = profiler.now()
+        items, self.event_handlers = self._resolve_items(op_results, context)
+        self._hit_grid = None
+        damage = self._damage(items)
+        self._drawn_items = items
+        if profiler is not None:
+            profiler.span('resolve items', start, items=len(items))
+            start = profiler.now()
+        draw_item = self._draw_item if profiler is None else self._profiled_draw_item
+
         canvas.save()
-        canvas.clear(0xff000000)
-
-        new_event_handlers = []
-
-        op_results = UIClient.resolve_oplist(self.scene['oplist'], context)
-
-        for item in self.scene['scene']:
-            if item['type'] == 'clear':
-                canvas.clear(item['color'])
-            elif item['type'] == 'rect':
-                canvas.drawRect(skia.Rect(
-                    op_results[item['rect'][0]],
-                    op_results[item['rect'][1]],
-                    op_results[item['rect'][2]],
-                    op_results[item['rect'][3]]
-                ), self._paint_from_int_color(op_results[item['color']]))
-            elif item['type'] == 'rrect':
-                canvas.drawRRect(skia.RRect(
-                    skia.Rect(
-                        op_results[item['rect'][0]],
-                        op_results[item['rect'][1]],
-                        op_results[item['rect'][2]],
-                        op_results[item['rect'][3]],
-                    ),
-                    op_results[item['radius']],
-                    op_results[item['radius']],
-                ), self._paint_from_int_color(op_results[item['color']]))
-            elif item['type'] == 'save':
-                canvas.save()
-            elif item['type'] == 'restore':
-                canvas.restore()
-            elif item['type'] == 'clipRect':
-                canvas.clipRect(skia.Rect(
-                    op_results[item['rect'][0]],
-                    op_results[item['rect'][1]],
-                    op_results[item['rect'][2]],
-                    op_results[item['rect'][3]]
-                ))
-            elif item['type'] == 'text':
-                paint = self._paint_from_int_color(op_results[item['color']])
-                font_size = op_results[item['fontSize']]
-                font = UIClient.get_font('Cantarell', font_size)
-                text = op_results[item['text']]
-                measurement = font.measureText(text, skia.TextEncoding.kUTF8, None, paint)
-
-                canvas.drawString(
-                    text,
-                    # TODO: Add alignment parameter
-                    op_results[item['x']] - measurement // 2,
-                    op_results[item['y']] + font_size // 2,
-                    font,
-                    paint
-                )
-            elif item['type'] == 'image':
-                rect = (
-                    op_results[item['rect'][0]],
-                    op_results[item['rect'][1]],
-                    op_results[item['rect'][2]],
-                    op_results[item['rect'][3]],
-                )
-                # width, height = rect[2] - rect[0], rect[3] - rect[1]
-                if item['uri'] not in self.image_cache:
-                    image = skia.Image.open(item['uri'])
-                    # image = image.resize(width, height)
-                    image = image.convert(alphaType=skia.kUnpremul_AlphaType)
-                    self.image_cache[item['uri']] = image
+        if damage is None:
+            self.draw_stats['full'] += 1
+            canvas.clear(0xff000000)
+            for params, _ in items:
+                draw_item(canvas, params)
+        elif damage.isEmpty():
+            self.draw_stats['unchanged'] += 1
+        else:
+            self.draw_stats['partial'] += 1
+            canvas.clipRegion(damage)
+            canvas.clear(0xff000000)
+            box = damage.getBounds()
+            box_left, box_top = box.left() - UIClient.DAMAGE_PADDING, box.top() - UIClient.DAMAGE_PADDING
+            box_right, box_bottom = box.right() + UIClient.DAMAGE_PADDING, box.bottom() + UIClient.DAMAGE_PADDING
+            for params, rect in items:
+                # Items without a rect (clear, save, clipRect, ...) change how the others are drawn
+                if rect is not None:
+                    left, top, right, bottom = rect
+                    # Most items are nowhere near, skip them before making an IRect to ask the region
+                    if (left > box_right and right > box_right) or (left < box_left and right < box_left) or \
+                            (top > box_bottom and bottom > box_bottom) or (top < box_top and bottom < box_top):
+                        continue
+                    if not damage.intersects(self._damage_bounds(rect)):
+                        continue
+                draw_item(canvas, params)
+        canvas.restore()
+        if profiler is not None:
+            profiler.end_draw_ops(start)
+
+    def _resolve_items(self, op_results, context):
+        """
+        Returns the scene's drawing items as (params, rect), params being what's needed to draw it and rect where it
+        draws (or None when it's not about pixels, like save), and the event handlers.
+        """
+        items = []
+        event_handlers = []
+        scene_items = self._scene['scene']
+        i = 0
+        while i < len(scene_items):
+            run = self._picture_runs.get(i)
+            if run is None:
+                self._resolve_item(scene_items[i], op_results, items, event_handlers)
+                i += 1
+                continue
+
+            values = [(type(value), value) for value in (context.get(name, 0) for name in run.var_names)]
+            changed = run.values is not None and values != run.values
+            if run.item is None or changed:
+                run_items = []
+                run.event_handlers = []
+                for item in scene_items[run.start:run.end]:
+                    self._resolve_item(item, op_results, run_items, run.event_handlers)
+                if changed:
+                    # Probably changing every frame (e.g. scrolling), only record it again once it settles
+                    run.item = None
+                    items += run_items
+                else:
+                    run.item = self._record_picture(run_items)
+                    self.draw_stats['pictures_recorded'] += 1
+            run.values = values
+            if run.item is not None:
+                items.append(run.item)
+            event_handlers += run.event_handlers
+            i = run.end
+        return items, event_handlers
+
+    def _record_picture(self, items):
+        """
+        Returns the (params, rect) drawing items with a skia.Picture.
+        """
+        bounds = [self._damage_bounds(rect) for _, rect in items if rect is not None]
+        if bounds:
+            rect = (
+                min(irect.left() for irect in bounds),
+                min(irect.top() for irect in bounds),
+                max(irect.right() for irect in bounds),
+                max(irect.bottom() for irect in bounds),
+            )
+        else:
+            rect = (0, 0, 0, 0)
+
+        recorder = skia.PictureRecorder()
+        # Items are clamped to the window by _damage_bounds, invalidate() (on resize) throws the pictures away
+        canvas = recorder.beginRecording(skia.Rect(*rect), skia.RTreeFactory()())
+        for params, _ in items:
+            self._draw_item(canvas, params)
+        has_rrect = any(params[0] == 'rrect' for params, _ in items)
+        return ('picture', recorder.finishRecordingAsPicture(), has_rrect), rect
+
+    def _resolve_item(self, item, op_results, items, event_handlers):
+        if item['type'] == 'clear':
+            items.append((('clear', item['color']), None))
+        elif item['type'] == 'rect':
+            rect = tuple(op_results[index] for index in item['rect'])
+            items.append((('rect', rect, op_results[item['color']]), rect))
+        elif item['type'] == 'rrect':
+            rect = tuple(op_results[index] for index in item['rect'])
+            params = ('rrect', rect, op_results[item['radius']], op_results[item['color']])
+            items.append((params, rect))
+        elif item['type'] in ('save', 'restore'):
+            items.append(((item['type'],), None))
+        elif item['type'] == 'clipRect':
+            items.append((('clipRect', tuple(op_results[index] for index in item['rect'])), None))
+        elif item['type'] == 'text':
+            color = op_results[item['color']]
+            font_size = op_results[item['fontSize']]
+            blob, measurement, ink = self._text_blob('Cantarell', font_size, op_results[item['text']])
+
+            # TODO: Add alignment parameter
+            x = op_results[item['x']] - measurement // 2
+            y = op_results[item['y']] + font_size // 2
+            ink_rect = (x + ink[0], y + ink[1], x + ink[2], y + ink[3])
+            items.append((('text', blob, x, y, color), ink_rect))
+        elif item['type'] == 'image':
+            rect = tuple(op_results[index] for index in item['rect'])
+            items.append((('image', self._image(item['uri'], rect), rect), rect))
+        elif item['type'] == 'evtHnd':
+            rect = (
+                op_results[item['rect'][0]],
+                op_results[item['rect'][1]],
+                op_results[item['rect'][2]],
+                op_results[item['rect'][3]],
+            )
+            event_handlers.append({
+                'rect': rect,
+                'events': item['events'],
+                'handler': item['handler'],
+                'item': item,
+            })
 
+    def _image(self, uri, rect):
+        """
+        Returns the image scaled for rect, or None while it's being decoded (or if it can't be).
+        """
+        key = (uri, size_bucket(rect))
+        image = self.image_cache.get(key)
+        if image is None and key not in self._failed_images:
+            self._image_decoder.decode(*key)
+        return image
+
+    def _image_decoded(self, key, image):
+        if image is None:
+            self._failed_images.add(key)
+        else:
+            self.image_cache.put(key, image, image.width() * image.height() * image.imageInfo().bytesPerPixel())
+        self.request_redraw()
+
+    def _damage_bounds(self, rect):
+        """
+        Returns the pixels an item drawn in rect may touch.
+        """
+        try:
+            left, right = sorted(rect[0::2])
+            top, bottom = sorted(rect[1::2])
+            # Padded for antialiasing, clamped first so infinite rects work too
+            return skia.IRect.MakeLTRB(
+                math.floor(max(left, -1)) - UIClient.DAMAGE_PADDING,
+                math.floor(max(top, -1)) - UIClient.DAMAGE_PADDING,
+                math.ceil(min(right, self.width + 1)) + UIClient.DAMAGE_PADDING,
+                math.ceil(min(bottom, self.height + 1)) + UIClient.DAMAGE_PADDING,
+            )
+        except (TypeError, ValueError):
+            # NaN, let the whole window be damaged
+            return skia.IRect.MakeLTRB(-1, -1, self.width + 1, self.height + 1)
+
+    def _damage(self, items):
+        """
+        Returns the skia.Region to paint again after the last frame drawn, or None to paint everything.
+        """
+        if self._drawn_items is None or len(items) != len(self._drawn_items):
+            return None
+
+        max_area = UIClient.FULL_REDRAW_DAMAGE * self.width * self.height
+        damage = skia.Region()
+        for item, drawn_item in zip(items, self._drawn_items):
+            if item == drawn_item:
+                continue
+            rect, drawn_rect = item[1], drawn_item[1]
+            if rect is None or drawn_rect is None:
+                return None
+            damage.op(self._damage_bounds(rect), skia.Region.kUnion_Op)
+            damage.op(self._damage_bounds(drawn_rect), skia.Region.kUnion_Op)
+            # Damage only grows, and adding to a complex region gets slow when most of the scene changed
+            damage_bounds = damage.getBounds()
+            if damage_bounds.width() * damage_bounds.height() > max_area:
+                return None
+
+        # Skia antialiases the edges of round rects differently when they're clipped, never cut through one
+        grown = not damage.isEmpty()
+        while grown:
+            grown = False
+            for params, rect in items:
+                if params[0] == 'rrect' or (params[0] == 'picture' and params[2]):
+                    bounds = self._damage_bounds(rect)
+                    if damage.intersects(bounds) and not damage.contains(bounds):
+                        damage.op(bounds, skia.Region.kUnion_Op)
+                        grown = True
+
+        damage_bounds = damage.getBounds()
+        if damage_bounds.width() * damage_bounds.height() > max_area:
+            return None
+        return damage
+
+    def _profiled_draw_item(self, canvas: skia.Canvas, params):
+        start = time.perf_counter_ns()
+        self._draw_item(canvas, params)
+        self.profiler.draw_op(params[0], time.perf_counter_ns() - start)
+
+    def _draw_item(self, canvas: skia.Canvas, params):
+        if params[0] == 'clear':
+            canvas.clear(params[1])
+        elif params[0] == 'rect':
+            _, rect, color = params
+            self._rect.setLTRB(*rect)
+            canvas.drawRect(self._rect, self._paint(color))
+        elif params[0] == 'rrect':
+            _, rect, radius, color = params
+            self._rect.setLTRB(*rect)
+            self._rrect.setRectXY(self._rect, radius, radius)
+            canvas.drawRRect(self._rrect, self._paint(color))
+        elif params[0] == 'save':
+            canvas.save()
+        elif params[0] == 'restore':
+            canvas.restore()
+        elif params[0] == 'clipRect':
+            self._rect.setLTRB(*params[1])
+            canvas.clipRect(self._rect)
+        elif params[0] == 'picture':
+            canvas.drawPicture(params[1])
+        elif params[0] == 'text':
+            _, blob, x, y, color = params
+            if blob is not None:
+                canvas.drawTextBlob(blob, x, y, self._paint(color))
+        elif params[0] == 'image':
+            _, image, rect = params
+            self._rect.setLTRB(*rect)
+            if image is None:
+                canvas.drawRect(self._rect, self._paint(UIClient.IMAGE_PLACEHOLDER_COLOR))
+            else:
                 canvas.drawImageRect(
-                    image=self.image_cache[item['uri']],
-                    dst=skia.Rect(rect[0], rect[1], rect[2], rect[3]),
+                    image=image,
+                    dst=self._rect,
                 )
-                # canvas.drawRect(
-                #     rect=skia.Rect(rect[0] + 100, rect[1] + 100, rect[2] - 100, rect[3] - 100),
-                #     paint=skia.Paint(
-                #         Color=0xa0000000,
-                #         ImageFilter=skia.ImageFilters.Blur(32.0, 32.0, tileMode=skia.TileMode.kClamp),
-                #     ),
-                # )
-            elif item['type'] == 'evtHnd':
-                rect = (
-                    op_results[item['rect'][0]],
-                    op_results[item['rect'][1]],
-                    op_results[item['rect'][2]],
-                    op_results[item['rect'][3]],
-                )
-                new_event_handlers.append({
-                    'rect': rect,
-                    'events': item['events'],
-                    'handler': item['handler'],
-                    'oplist': item['oplist'],
-                })
-
-        self.event_handlers = new_event_handlers
-        canvas.restore()
+            # canvas.drawRect(
+            #     rect=skia.Rect(rect[0] + 100, rect[1] + 100, rect[2] - 100, rect[3] - 100),
+            #     paint=skia.Paint(
+            #         Color=0xa0000000,
+            #         ImageFilter=skia.ImageFilters.Blur(32.0, 32.0, tileMode=skia.TileMode.kClamp),
+            #     ),
+            # )
 
     def handle_mouse_down(self, x: int, y: int):
         MOUSE_DOWN_EVT = 1 << 0
+        # After the wheel events that came before it
+        self._dispatch_scroll()
         self._handle_event_generic(x, y, {}, MOUSE_DOWN_EVT)
 
     def handle_scroll(self, x: int, y: int, scroll_x: int, scroll_y: int):
+        """
+        Wheel events are added up until flush_input, or until one comes at another position.
+        """
+        self.input_stats['wheel_events'] += 1
+        if self._pending_scroll is not None and self._pending_scroll[:2] != [x, y]:
+            self._dispatch_scroll()
+        if self._pending_scroll is None:
+            self._pending_scroll = [x, y, 0, 0]
+        self._pending_scroll[2] += scroll_x
+        self._pending_scroll[3] += scroll_y
+
+    def _dispatch_scroll(self):
         MOUSE_SCROLL_EVT = 1 << 1
+        if self._pending_scroll is None:
+            return
+        x, y, scroll_x, scroll_y = self._pending_scroll
+        self._pending_scroll = None
+        self.input_stats['scroll_dispatches'] += 1
         self._handle_event_generic(x, y, {
             'scroll_x': scroll_x,
             'scroll_y': scroll_y
         }, MOUSE_SCROLL_EVT)
 
+    def flush_input(self):
+        """
+        Dispatches the wheel events added up so far, and sends the replies of all the events and watches since the last
+        call in a single packet. The main loop calls it once per frame, before drawing.
+        """
+        self._dispatch_scroll()
+        self._flush_replies()
+
+    def _flush_replies(self):
+        with self._replies_lock:
+            replies, self._pending_replies = self._pending_replies, []
+        if replies:
+            self.input_stats['reply_packets'] += 1
+            self.input_stats['replies'] += len(replies)
+            self._send_replies(replies)
+
     def _eval_handlers(self, handlers, op_results):
         replies = []
         for handler in handlers:
             if handler['type'] == 'reply':
-                formatted_data = handler['id'].to_bytes(4, 'big')
-                for data in handler['data']:
-                    val = op_results[data]
-
-                    if isinstance(val, int):
-                        formatted_data += b'\x00'
-                        formatted_data += val.to_bytes(8, 'big', signed=True)
-                    elif isinstance(val, float):
-                        formatted_data += b'\x01'
-                        formatted_data += struct.pack('>d', val)
-                    else:
-                        raise ValueError('Invalid reply data type: {}'.format(type(val)))
-                replies.append(formatted_data)
+                # Encoded in one go by _send_replies
+                replies.append((handler['id'], [op_results[data] for data in handler['data']]))
             elif handler['type'] == 'setVar':
                 self.persistent_context[handler['name']] = op_results[handler['value']]
+                self.request_redraw()
                 self._should_update_watches = True
                 replies += self.update_watches()
         return replies
 
     def _send_replies(self, replies):
-        self.protocol.send_packet(
-            Actions.HANDLER_REPLY.to_bytes(4, 'big')
-            + len(replies).to_bytes(2, 'big')
-            + b''.join(((len(reply) - 4).to_bytes(2, 'big') + reply) for reply in replies)
-        )
+        self.protocol.send_packet(Actions.HANDLER_REPLY.to_bytes(4, 'big'), wire.encode_replies(replies))
+
+    def _event_context(self, event_vars):
+        return EventContext({
+            'width': self.width,
+            'height': self.height,
+            'time': time.time() - self._start_time,
+            **event_vars,
+        }, self.persistent_context)
+
+    def _handler_oplist(self, item):
+        entry = self._handler_oplists.get(id(item))
+        # The id of an item from a previous scene may have been reused
+        if entry is None or entry[0] is not item:
+            entry = self._handler_oplists[id(item)] = (item, HandlerOplist(item['oplist'], item['handler'],
+                                                                            UIClient.measure_text))
+        return entry[1]
 
     def _handle_event_generic(self, x: int, y: int, extra_context: Dict, event_mask: int):
-        context = {
-            **self.context,
-            'event_x': x,
-            'event_y': y,
-            **extra_context,
-        }
+        if self.profiler is not None:
+            start = self.profiler.now()
+        if self._hit_grid is None:
+            self._hit_grid = HitGrid(self.event_handlers, self.width, self.height)
+        handlers = [handler for handler in self._hit_grid.query(x, y) if handler['events'] & event_mask]
+        if self.topmost_events:
+            handlers = handlers[-1:]
+
+        context = self._event_context({'event_x': x, 'event_y': y, **extra_context})
+        # All evaluated before any setVar, like with a copy of the context
+        op_results = [self._handler_oplist(handler['item'])(context) for handler in handlers]
+
         replies = []
-        for handler in self.event_handlers:
-            if handler['events'] & event_mask and \
-                    handler['rect'][0] <= x <= handler['rect'][2] and handler['rect'][1] <= y <= handler['rect'][3]:
-                op_results = UIClient.resolve_oplist(handler['oplist'], context)
-                replies += self._eval_handlers(handler['handler'], op_results)
+        for handler, handler_results in zip(handlers, op_results):
+            replies += self._eval_handlers(handler['handler'], handler_results)
 
         replies += self.update_watches()
 
-        if replies:
-            self._send_replies(replies)
+        # Sent by flush_input
+        with self._replies_lock:
+            self._pending_replies += replies
+        if self.profiler is not None:
+            self.profiler.span('event', start, handlers=len(handlers), replies=len(replies))
 
     def update_watches(self, send=False):
         replies = []
@@ -459,22 +1033,36 @@ class UIClient:
         for _ in range(UIClient.WATCH_RECURSION):
             if self._should_update_watches:
                 self._should_update_watches = False
-                op_results = UIClient.resolve_oplist(self.scene['oplist'], context)
-                for op in self.scene['scene']:
-                    if op['type'] == 'watch':
-                        if op['id'] not in self._blocked_watches:
-                            if op_results[op['cond']]:
-                                replies += self._eval_handlers(op['handler'], op_results)
-                                if op['waitForRoundtrip']:
-                                    self._blocked_watches.add(op['id'])
+                watch_index = self._latest_scene.watch_index
+                for i, (op, cond) in enumerate(zip(watch_index.watches, watch_index.conds(context))):
+                    if op['id'] not in self._blocked_watches:
+                        if cond:
+                            replies += self._eval_handlers(op['handler'], watch_index.handler_results(i, context))
+                            if op['waitForRoundtrip']:
+                                self._blocked_watches.add(op['id'])
             else:
                 break
 
         if send:
-            self._send_replies(replies)
+            self._queue_replies(replies)
         else:
             return replies
 
+    def _queue_replies(self, replies):
+        """
+        Has the main loop send the replies with the next flush_input, along with those of the frame's input.
+        """
+        if not replies:
+            return
+        with self._replies_lock:
+            self._pending_replies += replies
+        wake_main_loop = self.wake_main_loop
+        if wake_main_loop is not None:
+            wake_main_loop()
+        else:
+            # No main loop (yet) to do it
+            self._flush_replies()
+
     def ack_watch(self, ack_id: int):
         if ack_id in self._blocked_watches:
             self._blocked_watches.remove(ack_id)
@@ -482,9 +1070,38 @@ class UIClient:
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} <socket-path>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('socket_path')
+    parser.add_argument('--compression', choices=Protocol.COMPRESSION_FEATURES.keys(), default='none',
+                        help='Ask the server to compress scene and var packets, and to send scenes in the binary '
+                             'encoding (useful over slow links)')
+    parser.add_argument('--no-scene-cache', action='store_true',
+                        help="Don't show the last scene on startup, and don't save it on exit")
+    parser.add_argument('--continuous', action='store_true',
+                        help='Redraw every frame, instead of only when something on screen may have changed')
+    parser.add_argument('--evaluator', choices=UIClient.EVALUATORS.keys(), default='compiled',
+                        help='How to evaluate oplists, numpy (if installed) computes arithmetic as array ops')
+    parser.add_argument('--topmost-events', action='store_true',
+                        help='Only send mouse events to the topmost handler under the pointer, not all of them')
+    parser.add_argument('--record-scenes', metavar='PATH',
+                        help='Keep writing the latest scene from the server to PATH as JSON, from another thread '
+                             '(for utils/visualize_scene_graph.py)')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Time the latest frames and write them to PATH as a Chrome trace on SIGUSR1 and at exit, '
+                             'with histograms of how long each type of op takes to draw')
+    args = parser.parse_args()
+    if args.evaluator == 'numpy' and oplist_vectorized.np is None:
+        parser.error('--evaluator numpy needs numpy installed')
 
-    state = UIClient(sys.argv[1])
-    sys.exit(main_loop(state))
+    state = UIClient(args.socket_path, compression=args.compression, use_scene_cache=not args.no_scene_cache,
+                     evaluator=args.evaluator, topmost_events=args.topmost_events, record_scenes=args.record_scenes,
+                     profile=args.profile)
+    if state.profiler:
+        state.profiler.dump_on_signal()
+    exit_code = main_loop(state, on_demand=not args.continuous)
+    state.save_scene_cache()
+    if state.scene_recorder:
+        state.scene_recorder.close()
+    if state.profiler:
+        state.profiler.dump()
+    sys.exit(exit_code)
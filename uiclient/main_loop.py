@@ -11,10 +11,15 @@ import skia
 from OpenGL import GL
 
 WIDTH, HEIGHT = 1280, 720
+IDLE_WAIT_MS = 1000
 fps_font = None
 
 
-def main_loop(state):
+def main_loop(state, on_demand=True):
+    """
+    With on_demand, frames are only drawn when something on screen may have changed (input, a resize, a scene or var
+    from the server, or a scene reading `time`), and otherwise the loop sleeps in SDL_WaitEventTimeout.
+    """
     global fps_font
 
     if sdl2.SDL_Init(sdl2.SDL_INIT_VIDEO) != 0:
@@ -32,6 +37,16 @@ def main_loop(state):
     context = sdl2.SDL_GL_CreateContext(window)
     # sdl2.SDL_GL_SetSwapInterval(0)
 
+    # Pushed by other threads (see UIClient.request_redraw) to wake the loop up, SDL_PushEvent is thread-safe
+    wake_event_type = sdl2.SDL_RegisterEvents(1)
+
+    def wake():
+        wake_event = sdl2.SDL_Event()
+        wake_event.type = wake_event_type
+        sdl2.SDL_PushEvent(ctypes.byref(wake_event))
+
+    state.wake_main_loop = wake
+
     event = sdl2.SDL_Event()
     running = True
 
@@ -46,32 +61,71 @@ def main_loop(state):
     gl_context = skia.GrDirectContext.MakeGL()
     assert context is not None
 
+    # None unless --profile
+    profiler = state.profiler
+
+    def handle_event():
+        """
+        Returns whether the event may change what's on screen.
+        """
+        nonlocal running, resized
+        if event.type == sdl2.SDL_QUIT:
+            running = False
+        elif event.type == sdl2.SDL_MOUSEBUTTONDOWN:
+            state.handle_mouse_down(event.button.x, event.button.y)
+        elif event.type == sdl2.SDL_MOUSEWHEEL:
+            x = ctypes.c_int()
+            y = ctypes.c_int()
+            sdl2.SDL_GetMouseState(x, y)
+            state.handle_scroll(x.value, y.value, event.wheel.x, event.wheel.y)
+        elif event.type == sdl2.SDL_WINDOWEVENT:
+            if event.window.event == sdl2.SDL_WINDOWEVENT_RESIZED:
+                # w, h = event.window.data1, event.window.data2
+                # print(f"Resized to {w} x {h}")
+                # state.resize(event.window.data1, event.window.data2)
+                resized = True
+            elif event.window.event == sdl2.SDL_WINDOWEVENT_FOCUS_GAINED:
+                state.wake_server()
+        elif event.type == sdl2.SDL_MOUSEMOTION:
+            # Nothing reacts to hovering
+            return False
+        return True
+
     while running:
         with skia_surface(window, gl_context) as surface:  # type: skia.Surface
             resized = False
             state.resize(surface.width(), surface.height())
+            # The window's back buffer is undefined after a swap, frames are kept here so only what changed is redrawn
+            back_buffer = surface.makeSurface(surface.width(), surface.height())
+            assert back_buffer is not None
+            state.invalidate()
+            redraw = True
             while running and not resized:
-                with surface as canvas:  # type: skia.Canvas
-                    while sdl2.SDL_PollEvent(ctypes.byref(event)) != 0:
-                        if event.type == sdl2.SDL_QUIT:
-                            running = False
-                            break
-                        elif event.type == sdl2.SDL_MOUSEBUTTONDOWN:
-                            state.handle_mouse_down(event.button.x, event.button.y)
-                        elif event.type == sdl2.SDL_MOUSEWHEEL:
-                            x = ctypes.c_int()
-                            y = ctypes.c_int()
-                            sdl2.SDL_GetMouseState(x, y)
-                            state.handle_scroll(x.value, y.value, event.wheel.x, event.wheel.y)
-                        elif event.type == sdl2.SDL_WINDOWEVENT:
-                            if event.window.event == sdl2.SDL_WINDOWEVENT_RESIZED:
-                                # w, h = event.window.data1, event.window.data2
-                                # print(f"Resized to {w} x {h}")
-                                # state.resize(event.window.data1, event.window.data2)
-                                resized = True
+                if on_demand and not redraw and not state.animated:
+                    # The timeout is only a safety net, the protocol thread wakes us up
+                    if sdl2.SDL_WaitEventTimeout(ctypes.byref(event), IDLE_WAIT_MS) != 0:
+                        redraw |= handle_event()
+                if profiler is not None:
+                    frame_start = profile_start = profiler.now()
+                while running and sdl2.SDL_PollEvent(ctypes.byref(event)) != 0:
+                    redraw |= handle_event()
+                # A trackpad fling sends dozens of wheel events per frame, they're handled (and replied to) as one
+                state.flush_input()
+                if profiler is not None:
+                    profiler.span('events', profile_start)
+                redraw |= state.take_redraw_request()
+                if not running or resized or (on_demand and not redraw and not state.animated):
+                    continue
+                redraw = False
 
+                with surface as canvas:  # type: skia.Canvas
                     start = time.time()
-                    state.draw(canvas)
+                    if profiler is not None:
+                        profile_start = profiler.now()
+                    state.draw(back_buffer.getCanvas())
+                    back_buffer.draw(canvas, 0, 0)
+                    if profiler is not None:
+                        profiler.span('draw', profile_start)
                     compute_frame_times += time.time() - start
 
                     # Draw FPS meter
@@ -80,7 +134,11 @@ def main_loop(state):
                         fps_font = skia.Font(skia.Typeface('Cantarell'), 12)
                     canvas.drawString(fps_str, 6, 16, fps_font, fps_paint)
 
+                    if profiler is not None:
+                        profile_start = profiler.now()
                     canvas.flush()
+                    if profiler is not None:
+                        profiler.span('canvas flush', profile_start)
 
                     draw_frame_times += time.time() - start
 
@@ -92,13 +150,21 @@ def main_loop(state):
                         fps = fps_counter / elapsed
                         c_ft = compute_frame_times / frame_counter * 1000
                         d_ft = draw_frame_times / frame_counter * 1000
-                        fps_str = f'FPS: {fps:.01f}  C.FT: {c_ft:.02f}ms  D.FT: {d_ft:.02f}ms'
+                        evaluate_oplist = state.evaluate_oplist
+                        fps_str = (f'FPS: {fps:.01f}  C.FT: {c_ft:.02f}ms  D.FT: {d_ft:.02f}ms  '
+                                   f'Eval: {evaluate_oplist.last_evaluated}/{evaluate_oplist.total}')
                         fps_counter = 0
                         last_measurement = time.time()
 
+                if profiler is not None:
+                    profile_start = profiler.now()
                 sdl2.SDL_GL_SwapWindow(window)
+                if profiler is not None:
+                    profiler.span('swap', profile_start)
+                    profiler.span('frame', frame_start, frame=frame_counter)
                 sdl2.SDL_Delay(1)
 
+    state.wake_main_loop = None
     gl_context.abandonContext()
     sdl2.SDL_GL_DeleteContext(context)
     sdl2.SDL_DestroyWindow(window)
@@ -0,0 +1,374 @@
+"""
+Evaluators for scene oplists, built once per scene so evaluating it every frame doesn't go through
+UIClient.resolve_op's chain of type comparisons and dict lookups for every entry.
+
+When a scene is loaded, each entry gets the set of vars it depends on (through the entries it references). The first
+evaluation computes everything, after that only the entries depending on a var whose value changed since the last
+evaluation are computed again (e.g. only the ones reading `time` for an animation), and entries that don't depend on
+any var are never computed again.
+
+The entries to recompute for a given set of changed vars form a plan. A plan starts out as closures, one per entry.
+Once it has run a few times it's turned into generated Python code CHUNK_SIZE entries at a time (compiling is slow,
+~10us per entry, so at most one chunk is compiled per evaluation):
+
+    def chunk(r, _get):
+        _256 = r[256] = _get('width', 0)
+        _257 = r[257] = _256 - r[3]
+
+Compiled chunks are cached by their source, so patched scenes reuse the chunks that didn't change.
+"""
+import collections
+import math
+import operator
+import threading
+
+CHUNK_SIZE = 256
+# Plans used less than this many times are never compiled
+WARMUP_CALLS = 3
+MAX_CACHED_CHUNKS = 256
+MAX_PLANS = 64
+
+# Fields of an op that hold oplist indices
+_REFERENCE_FIELDS = ('a', 'b', 'cond', 't', 'f', 'text', 'fontSize')
+
+_BINARY_FUNCTIONS = {
+    'add': operator.add, 'sub': operator.sub, 'mul': operator.mul, 'div': operator.truediv,
+    'fdiv': operator.floordiv, 'mod': operator.mod, 'pow': operator.pow, 'min': min, 'max': max,
+    'eq': operator.eq, 'ne': operator.ne, 'lt': operator.lt, 'le': operator.le, 'gt': operator.gt, 'ge': operator.ge,
+    'bAnd': operator.and_, 'bOr': operator.or_, 'bXor': operator.xor, 'shl': operator.lshift, 'shr': operator.rshift,
+}
+_UNARY_FUNCTIONS = {
+    'sqrt': lambda a: a ** 0.5, 'sin': math.sin, 'cos': math.cos, 'tan': math.tan, 'neg': operator.neg, 'abs': abs,
+    'bInvert': operator.invert, 'toStr': str,
+}
+_BINARY_OPERATORS = {
+    'add': '+', 'sub': '-', 'mul': '*', 'div': '/', 'fdiv': '//', 'mod': '%', 'pow': '**',
+    'eq': '==', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>=',
+    'bAnd': '&', 'bOr': '|', 'bXor': '^', 'shl': '<<', 'shr': '>>',
+}
+_UNARY_TEMPLATES = {
+    'sqrt': '{a} ** 0.5',
+    'sin': '_sin({a})',
+    'cos': '_cos({a})',
+    'tan': '_tan({a})',
+    'neg': '-{a}',
+    'abs': 'abs({a})',
+    'bInvert': '~{a}',
+    'toStr': 'str({a})',
+}
+
+_chunk_cache = {}
+
+
+def _fail(message):
+    raise ValueError(message)
+
+
+def _closure(op, measure_text):
+    if op is None:
+        return lambda r, c: 0
+    elif isinstance(op, (int, float, str)):
+        return lambda r, c: op
+    elif not isinstance(op, dict):
+        message = f'Unknown type: {op}'
+        return lambda r, c: _fail(message)
+
+    op_type = op['type']
+    if op_type in _BINARY_FUNCTIONS:
+        fn, a, b = _BINARY_FUNCTIONS[op_type], op['a'], op['b']
+        return lambda r, c: fn(r[a], r[b])
+    elif op_type in _UNARY_FUNCTIONS:
+        fn, a = _UNARY_FUNCTIONS[op_type], op['a']
+        return lambda r, c: fn(r[a])
+    elif op_type == 'inf':
+        return lambda r, c: float('inf')
+    elif op_type in ('measureTextX', 'measureTextY'):
+        text, font_size, axis = op['text'], op['fontSize'], int(op_type == 'measureTextY')
+        return lambda r, c: measure_text(r[text], r[font_size])[axis]
+    elif op_type == 'if':
+        cond, t, f = op['cond'], op['t'], op['f']
+        return lambda r, c: r[t] if r[cond] else r[f]
+    elif op_type == 'var':
+        name = op['name']
+        return lambda r, c: c.get(name, 0)
+    else:
+        message = f'Unknown operation: {op_type}'
+        return lambda r, c: _fail(message)
+
+
+def references(op):
+    """
+    Returns the oplist indices an op reads.
+    """
+    if not isinstance(op, dict) or op.get('type') == 'var':
+        return []
+    return [operator.index(op[field]) for field in _REFERENCE_FIELDS if field in op]
+
+
+def var_dependencies(oplist):
+    """
+    Returns the names of the vars each entry depends on, directly or through the entries it references.
+    """
+    deps = []
+    for i, op in enumerate(oplist):
+        if isinstance(op, dict) and op.get('type') == 'var':
+            op_deps = frozenset((op['name'],))
+        else:
+            op_deps = frozenset()
+            for index in references(op):
+                if not 0 <= index < i:
+                    raise ValueError(f'Entry #{i} references entry #{index}')
+                op_deps |= deps[index]
+        deps.append(op_deps)
+    return deps
+
+
+def reachable(oplist, roots):
+    """
+    Returns the sorted indices of the entries computing the roots: the roots and the entries they reference, directly or
+    not.
+    """
+    needed = set(operator.index(root) for root in roots)
+    if any(not 0 <= index < len(oplist) for index in needed):
+        raise IndexError('Reading past the end of the oplist')
+
+    # Entries only reference earlier ones
+    for i in range(max(needed, default=-1), -1, -1):
+        if i not in needed:
+            continue
+        for index in references(oplist[i]):
+            if not 0 <= index < i:
+                raise ValueError(f'Entry #{i} references entry #{index}')
+            needed.add(index)
+    return sorted(needed)
+
+
+def subgraph(oplist, roots):
+    """
+    Returns an oplist of only the entries computing the roots (see reachable), with their references renumbered, and
+    {index in oplist: index in the new oplist}.
+    """
+    indices = {}
+    entries = []
+    for i in reachable(oplist, roots):
+        op = oplist[i]
+        if isinstance(op, dict):
+            op = {key: indices[value] if key in _REFERENCE_FIELDS and op.get('type') != 'var' else value
+                  for key, value in op.items()}
+        indices[i] = len(entries)
+        entries.append(op)
+    return entries, indices
+
+
+def _expression(op, local) -> str:
+    def ref(index):
+        # The scene comes from the other end of a socket, only ever paste integers into the code
+        index = operator.index(index)
+        return f'_{index}' if index in local else f'r[{index}]'
+
+    if op is None:
+        return '0'
+    elif isinstance(op, (int, str)) or (isinstance(op, float) and math.isfinite(op)):
+        return repr(op)
+    elif isinstance(op, float):
+        return '_nan' if math.isnan(op) else '_inf' if op > 0 else '-_inf'
+    elif not isinstance(op, dict):
+        return f'_fail({repr(f"Unknown type: {op}")})'
+
+    op_type = op['type']
+    if op_type in _BINARY_OPERATORS:
+        return f'{ref(op["a"])} {_BINARY_OPERATORS[op_type]} {ref(op["b"])}'
+    elif op_type in _UNARY_TEMPLATES:
+        return _UNARY_TEMPLATES[op_type].format(a=ref(op['a']))
+    elif op_type in ('min', 'max'):
+        return f'{op_type}({ref(op["a"])}, {ref(op["b"])})'
+    elif op_type == 'inf':
+        return '_inf'
+    elif op_type == 'measureTextX':
+        return f'_measure_text({ref(op["text"])}, {ref(op["fontSize"])})[0]'
+    elif op_type == 'measureTextY':
+        return f'_measure_text({ref(op["text"])}, {ref(op["fontSize"])})[1]'
+    elif op_type == 'if':
+        return f'{ref(op["t"])} if {ref(op["cond"])} else {ref(op["f"])}'
+    elif op_type == 'var':
+        return f'_get({repr(op["name"])}, 0)'
+    else:
+        return f'_fail({repr(f"Unknown operation: {op_type}")})'
+
+
+def _chunk_source(oplist, indices) -> str:
+    local = set(indices)
+    lines = ['def chunk(r, _get):']
+    for i in indices:
+        lines.append(f'    _{i} = r[{i}] = {_expression(oplist[i], local)}')
+    return '\n'.join(lines)
+
+
+class _Plan:
+    def __init__(self, indices):
+        self.indices = indices
+        self.calls = 0
+        # Lists of indices until they're compiled
+        self.chunks = [indices[start:start + CHUNK_SIZE] for start in range(0, len(indices), CHUNK_SIZE)]
+        self.next_chunk = 0
+
+
+class CompiledOplist:
+    """
+    Drop-in for UIClient.resolve_oplist: called with the context, returns the list of results.
+    """
+    def __init__(self, oplist, measure_text):
+        # Received scenes are never changed (patches make a new one), so the oplist is shared rather than copied
+        self.oplist = oplist
+        self.measure_text = measure_text
+        self.total = len(self.oplist)
+        # Entries computed by the last evaluation, and over all evaluations (along with the total)
+        self.last_evaluated = 0
+        self.stats = collections.Counter()
+
+        # The vars each entry depends on
+        self.dependencies = var_dependencies(self.oplist)
+
+        self._steps = [_closure(op, measure_text) for op in self.oplist]
+        # Var name -> indices of the entries depending on it, in order
+        self._readers = collections.defaultdict(list)
+        for i, op_deps in enumerate(self.dependencies):
+            for name in op_deps:
+                self._readers[name].append(i)
+
+        self._results = None
+        self._values = {}
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, context):
+        with self._lock:
+            if self._results is None:
+                results = [None] * self.total
+                for i, step in enumerate(self._steps):
+                    results[i] = step(results, context)
+                self._results = results
+                self._values = {name: context.get(name, 0) for name in self._readers}
+                evaluated = self.total
+            else:
+                changed = []
+                for name, old_value in self._values.items():
+                    value = context.get(name, 0)
+                    # 1 == 1.0 == True, but they give different results with toStr
+                    if value != old_value or type(value) is not type(old_value):
+                        self._values[name] = value
+                        changed.append(name)
+                try:
+                    evaluated = self._run(frozenset(changed), context) if changed else 0
+                except BaseException:
+                    # Some results may be stale now, start over next time
+                    self._results = None
+                    raise
+
+            self.last_evaluated = evaluated
+            self.stats['evaluated'] += evaluated
+            self.stats['total'] += self.total
+            return list(self._results)
+
+    def _run(self, changed, context):
+        plan = self._plans.get(changed)
+        if plan is None:
+            if len(self._plans) >= MAX_PLANS:
+                self._plans.clear()
+            indices = sorted(set().union(*(self._readers[name] for name in changed)))
+            plan = self._plans[changed] = _Plan(indices)
+
+        plan.calls += 1
+        if plan.calls > WARMUP_CALLS and plan.next_chunk < len(plan.chunks):
+            self._compile_next_chunk(plan)
+
+        results = self._results
+        steps = self._steps
+        get = context.get
+        for chunk in plan.chunks:
+            if isinstance(chunk, list):
+                for i in chunk:
+                    results[i] = steps[i](results, context)
+            else:
+                chunk(results, get)
+        return len(plan.indices)
+
+    def _compile_next_chunk(self, plan):
+        # Chunks found in the cache are free, stop after the first one that actually had to be compiled
+        while plan.next_chunk < len(plan.chunks):
+            index = plan.next_chunk
+            plan.next_chunk += 1
+
+            source = _chunk_source(self.oplist, plan.chunks[index])
+            chunk = _chunk_cache.get(source)
+            if chunk is not None:
+                plan.chunks[index] = chunk
+                continue
+
+            plan.chunks[index] = _compile_chunk(source, self.measure_text)
+            break
+
+
+def _compile_chunk(source, measure_text):
+    namespace = {
+        '_sin': math.sin,
+        '_cos': math.cos,
+        '_tan': math.tan,
+        '_inf': float('inf'),
+        '_nan': float('nan'),
+        '_measure_text': measure_text,
+        '_fail': _fail,
+    }
+    exec(compile(source, '<oplist>', 'exec'), namespace)
+    if len(_chunk_cache) >= MAX_CACHED_CHUNKS:
+        del _chunk_cache[next(iter(_chunk_cache))]
+    _chunk_cache[source] = namespace['chunk']
+    return namespace['chunk']
+
+
+class HandlerOplist:
+    """
+    Drop-in for UIClient.resolve_oplist for the oplist of an event handler, with a new context every event. Compiled
+    to a single chunk that only computes the entries its handlers read (the data of replies and the values of setVars),
+    the others are left as None. Handlers of the same shape (list rows) share the chunk.
+    """
+    def __init__(self, oplist, handlers, measure_text):
+        self.total = len(oplist)
+        try:
+            needed = self._needed(oplist, handlers)
+        except (IndexError, KeyError, TypeError, ValueError):
+            # A broken handler fails the way it always did, when it's used
+            self._chunk = None
+            self._steps = [_closure(op, measure_text) for op in oplist]
+            self.evaluated = self.total
+            return
+
+        self._steps = []
+        if needed:
+            source = _chunk_source(oplist, needed)
+            self._chunk = _chunk_cache.get(source) or _compile_chunk(source, measure_text)
+        else:
+            self._chunk = None
+        self.evaluated = len(needed)
+
+    @staticmethod
+    def _needed(oplist, handlers):
+        roots = []
+        for handler in handlers:
+            if handler['type'] == 'reply':
+                roots += handler['data']
+            elif handler['type'] == 'setVar':
+                roots.append(handler['value'])
+        return reachable(oplist, roots)
+
+    def __call__(self, context):
+        if self._chunk is None:
+            # Like resolve_oplist, entries past the one being computed aren't there yet
+            results = []
+            for step in self._steps:
+                results.append(step(results, context))
+            return results + [None] * (self.total - len(results))
+
+        results = [None] * self.total
+        self._chunk(results, context.get)
+        return results
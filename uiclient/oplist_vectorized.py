@@ -0,0 +1,309 @@
+"""
+NumPy evaluator for scene oplists, for big generated scenes (like example_raw_stress.py) made of thousands of
+independent arithmetic expressions. Needs numpy, select it with `main.py --evaluator numpy`.
+
+Entries are grouped into levels (one more than the highest level of the entries they reference), so all the entries
+of a level can be computed at once. In a level, the arithmetic entries with the same operation and operand types are
+computed by one NumPy operation, anything else (toStr, measureText, sin, ...) goes through the same closures as
+CompiledOplist, one entry at a time. Entries that don't depend on any var are only computed when the scene is loaded.
+
+The results must be exactly those of UIClient.resolve_oplist, Python types included (1 + 1 is an int, 1 / 1 a float,
+1 < 2 a bool), so every entry has a type code, taken from evaluating the scene once with closures. An entry is only
+vectorized when its result type follows from its operands' types, and the levels are built again when a var or an
+entry computed by a closure gives a value of another type. When NumPy would differ from Python (dividing by zero, ints
+that could overflow 64 bits), that evaluation goes through the closures instead.
+"""
+import collections
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from oplist_compiler import _closure, references, var_dependencies
+
+# Type codes. Bools are stored with the ints, as 0 and 1
+_FLOAT = 'f'
+_INT = 'i'
+_BOOL = 'b'
+# Anything else, always computed by closures
+_OBJECT = 'o'
+
+_NUMERIC = (_FLOAT, _INT, _BOOL)
+_INTEGRAL = (_INT, _BOOL)
+
+_COMPARISONS = ('eq', 'ne', 'lt', 'le', 'gt', 'ge')
+
+# Int operands must be smaller than this (in absolute value) for the result to be the same as Python's
+_INT_LIMITS = {
+    'add': 2 ** 62,
+    'sub': 2 ** 62,
+    'mul': 2 ** 31,
+    # Converted to floats
+    'div': 2 ** 53,
+    'fdiv': 2 ** 62,
+    'mod': 2 ** 62,
+    'neg': 2 ** 62,
+    'abs': 2 ** 62,
+}
+
+
+def _type_code(value):
+    value_type = type(value)
+    if value_type is float:
+        return _FLOAT
+    elif value_type is bool:
+        return _BOOL
+    elif value_type is int:
+        return _INT if -2 ** 63 <= value < 2 ** 63 else _OBJECT
+    return _OBJECT
+
+
+def _result_type(op_type, arg_types):
+    """
+    Returns the type code of an op's result when it can be vectorized, or None.
+    """
+    if not all(arg_type in _NUMERIC for arg_type in arg_types):
+        return None
+
+    if op_type in ('add', 'sub', 'mul', 'fdiv', 'mod'):
+        return _FLOAT if _FLOAT in arg_types else _INT
+    elif op_type == 'div':
+        return _FLOAT
+    elif op_type in ('min', 'max'):
+        # min(1, 1.0) is 1 and min(1.0, 1) is 1.0, only vectorized when there's a single type
+        return arg_types[0] if arg_types[0] == arg_types[1] else None
+    elif op_type in _COMPARISONS:
+        return _BOOL
+    elif op_type in ('bAnd', 'bOr', 'bXor'):
+        if not all(arg_type in _INTEGRAL for arg_type in arg_types):
+            return None
+        return _BOOL if arg_types == (_BOOL, _BOOL) else _INT
+    elif op_type in ('neg', 'abs'):
+        return _FLOAT if arg_types[0] == _FLOAT else _INT
+    elif op_type == 'bInvert':
+        return _INT if arg_types[0] in _INTEGRAL else None
+    elif op_type == 'if':
+        _, t, f = arg_types
+        return t if t == f else None
+    return None
+
+
+if np is not None:
+    _VECTOR_FUNCTIONS = {
+        'add': np.add, 'sub': np.subtract, 'mul': np.multiply, 'div': np.true_divide,
+        'fdiv': np.floor_divide, 'mod': np.remainder,
+        # Same as Python's min/max, which keep the first argument unless the second is strictly smaller/bigger
+        'min': lambda a, b: np.where(b < a, b, a),
+        'max': lambda a, b: np.where(b > a, b, a),
+        'eq': np.equal, 'ne': np.not_equal, 'lt': np.less, 'le': np.less_equal, 'gt': np.greater,
+        'ge': np.greater_equal,
+        'bAnd': np.bitwise_and, 'bOr': np.bitwise_or, 'bXor': np.bitwise_xor,
+        'neg': np.negative, 'abs': np.abs, 'bInvert': np.invert,
+        # NaN is truthy in Python too
+        'if': lambda cond, t, f: np.where(cond != 0, t, f),
+    }
+
+
+class _Fallback(Exception):
+    pass
+
+
+class _Group:
+    def __init__(self, op_type, out_type, arg_types):
+        self.fn = _VECTOR_FUNCTIONS[op_type]
+        self.out_type = out_type
+        self.arg_types = arg_types
+        self.out = []
+        self.args = [[] for _ in arg_types]
+        self.checks = []
+        if op_type in ('div', 'fdiv', 'mod'):
+            # Python raises ZeroDivisionError
+            self.checks.append((1, 'nonzero', None))
+        limit = _INT_LIMITS.get(op_type)
+        if op_type in _COMPARISONS and _FLOAT in arg_types:
+            # Ints are compared to floats exactly in Python
+            limit = 2 ** 53
+        if limit is not None:
+            for position, arg_type in enumerate(arg_types):
+                if arg_type == _INT:
+                    self.checks.append((position, 'limit', limit))
+
+    def finish(self):
+        self.out = np.array(self.out, dtype=np.intp)
+        self.args = [np.array(indices, dtype=np.intp) for indices in self.args]
+
+
+class _Plan:
+    def __init__(self, oplist, dependencies, steps, results):
+        self.types = [_type_code(value) for value in results]
+        self.floats = np.zeros(len(results), dtype=np.float64)
+        self.ints = np.zeros(len(results), dtype=np.int64)
+        self.objects = [None] * len(results)
+        self.arrays = {_FLOAT: self.floats, _INT: self.ints, _BOOL: self.ints}
+
+        # (index, name, type code)
+        self.vars = []
+        # Each one a list of groups and a list of (index, closure, type code) for the rest
+        self.levels = []
+        self.dynamic = 0
+
+        levels = [0] * len(oplist)
+        for i, (op, op_deps) in enumerate(zip(oplist, dependencies)):
+            if not op_deps:
+                self._store(i, results[i])
+                continue
+
+            self.dynamic += 1
+            if op.get('type') == 'var':
+                self.vars.append((i, op['name'], self.types[i]))
+                continue
+
+            # In the order the vector functions take them (cond, t, f for `if`)
+            args = references(op)
+            levels[i] = level = 1 + max(levels[index] for index in args)
+            while len(self.levels) < level:
+                self.levels.append(({}, []))
+            groups, scalars = self.levels[level - 1]
+
+            arg_types = tuple(self.types[index] for index in args)
+            out_type = _result_type(op['type'], arg_types)
+            if out_type is None or out_type != self.types[i]:
+                scalars.append((i, steps[i], self.types[i]))
+                continue
+            key = (op['type'], arg_types)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = _Group(op['type'], out_type, arg_types)
+            group.out.append(i)
+            for indices, index in zip(group.args, args):
+                indices.append(index)
+
+        self.levels = [([group for group in groups.values()], scalars) for groups, scalars in self.levels]
+        for groups, _ in self.levels:
+            for group in groups:
+                group.finish()
+
+        # Results that never change are only converted to Python objects once
+        self.constants = np.empty(len(results), dtype=object)
+        by_type = collections.defaultdict(list)
+        for i, op_deps in enumerate(dependencies):
+            if op_deps:
+                by_type[self.types[i]].append(i)
+            else:
+                self.constants[i] = results[i]
+        self.float_indices = np.array(by_type[_FLOAT], dtype=np.intp)
+        self.int_indices = np.array(by_type[_INT], dtype=np.intp)
+        self.bool_indices = np.array(by_type[_BOOL], dtype=np.intp)
+        self.object_indices = by_type[_OBJECT]
+
+    def __getitem__(self, i):
+        # Lets the closures read results
+        type_code = self.types[i]
+        if type_code == _FLOAT:
+            return float(self.floats[i])
+        elif type_code == _INT:
+            return int(self.ints[i])
+        elif type_code == _BOOL:
+            return bool(self.ints[i])
+        return self.objects[i]
+
+    def _store(self, i, value):
+        type_code = self.types[i]
+        if type_code in self.arrays:
+            self.arrays[type_code][i] = value
+        else:
+            self.objects[i] = value
+
+    def run(self, context):
+        for i, name, type_code in self.vars:
+            value = context.get(name, 0)
+            if _type_code(value) != type_code:
+                raise _Fallback()
+            self._store(i, value)
+
+        with np.errstate(all='ignore'):
+            for groups, scalars in self.levels:
+                for group in groups:
+                    values = [self.arrays[arg_type][indices] for arg_type, indices in zip(group.arg_types, group.args)]
+                    for position, check, limit in group.checks:
+                        value = values[position]
+                        if check == 'nonzero':
+                            if not value.all():
+                                raise _Fallback()
+                        elif value.max() >= limit or value.min() <= -limit:
+                            raise _Fallback()
+                    self.arrays[group.out_type][group.out] = group.fn(*values)
+
+                for i, step, type_code in scalars:
+                    value = step(self, context)
+                    if _type_code(value) != type_code:
+                        raise _Fallback()
+                    self._store(i, value)
+
+        results = self.constants.copy()
+        results[self.float_indices] = self.floats[self.float_indices]
+        results[self.int_indices] = self.ints[self.int_indices]
+        results[self.bool_indices] = self.ints[self.bool_indices].astype(bool)
+        results = results.tolist()
+        for i in self.object_indices:
+            results[i] = self.objects[i]
+        return results
+
+
+class VectorizedOplist:
+    """
+    Drop-in for UIClient.resolve_oplist (and CompiledOplist): called with the context, returns the list of results.
+    """
+    def __init__(self, oplist, measure_text):
+        if np is None:
+            raise RuntimeError('The numpy evaluator needs numpy')
+        self.oplist = list(oplist)
+        self.total = len(self.oplist)
+        self.last_evaluated = 0
+        self.stats = collections.Counter()
+
+        self._steps = [_closure(op, measure_text) for op in self.oplist]
+        self._var_names = {op['name'] for op in self.oplist if isinstance(op, dict) and op.get('type') == 'var'}
+        # The vars each entry depends on, also fails early on bad references like CompiledOplist
+        self.dependencies = var_dependencies(self.oplist)
+        self._plan = None
+        self._results = None
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, context):
+        with self._lock:
+            values = {name: context.get(name, 0) for name in self._var_names}
+            if self._results is not None and all(
+                    value == self._values[name] and type(value) is type(self._values[name])
+                    for name, value in values.items()):
+                evaluated = 0
+            else:
+                self._results = None
+                if self._plan is None:
+                    self._results = self._run_closures(context)
+                    evaluated = self.total
+                else:
+                    try:
+                        self._results = self._plan.run(context)
+                        evaluated = self._plan.dynamic
+                    except _Fallback:
+                        self._results = self._run_closures(context)
+                        evaluated = self.total
+                self._values = values
+
+            self.last_evaluated = evaluated
+            self.stats['evaluated'] += evaluated
+            self.stats['total'] += self.total
+            return list(self._results)
+
+    def _run_closures(self, context):
+        results = [None] * self.total
+        for i, step in enumerate(self._steps):
+            results[i] = step(results, context)
+        if self._plan is None or any(_type_code(value) != type_code
+                                     for value, type_code in zip(results, self._plan.types)):
+            self._plan = _Plan(self.oplist, self.dependencies, self._steps, results)
+        return results
@@ -0,0 +1,78 @@
+"""
+Runs of scene items that don't depend on vars changing every frame are recorded into a skia.Picture, which is replayed
+with drawPicture until one of the vars the run depends on changes (and thrown away with the scene).
+"""
+
+# Items that can go in a picture. save/restore must be balanced inside a run, and a clipRect outside of one would clip
+# what comes after the run (drawPicture restores the canvas). Images are left out, they're drawn with a placeholder
+# until decoded and a gallery filling in would record the whole run again for every image
+PICTURE_ITEM_TYPES = ('rect', 'rrect', 'text', 'clipRect', 'save', 'restore', 'evtHnd', 'watch')
+# Fields of scene items that hold oplist indices
+_INDEX_FIELDS = ('color', 'radius', 'text', 'x', 'y', 'fontSize')
+# Vars that change every frame, items reading them are always drawn directly
+PER_FRAME_VARS = frozenset(('time',))
+# Shorter runs are drawn directly, recording them isn't worth it
+MIN_RUN_ITEMS = 8
+
+
+class PictureRun:
+    def __init__(self, start, end, var_names):
+        # Scene item indices
+        self.start = start
+        self.end = end
+        self.var_names = sorted(var_names)
+        # The values of var_names last time the run was drawn, as (type, value)
+        self.values = None
+        # (params, rect) standing for the run in UIClient.draw, and the run's event handlers
+        self.item = None
+        self.event_handlers = None
+
+
+def _recordable(item, depth, dependencies):
+    """
+    Returns the vars the item depends on if it can be recorded (`depth` saves deep in a run), or None.
+    """
+    if item['type'] not in PICTURE_ITEM_TYPES or (item['type'] in ('restore', 'clipRect') and depth == 0):
+        return None
+    if item['type'] == 'watch':
+        # Not drawn
+        return frozenset()
+
+    item_deps = frozenset()
+    try:
+        for index in [*item.get('rect', ()), *(item[field] for field in _INDEX_FIELDS if field in item)]:
+            item_deps |= dependencies[index]
+    except (IndexError, TypeError):
+        # Bad reference, drawn directly so it fails like it would without pictures
+        return None
+    return item_deps if item_deps.isdisjoint(PER_FRAME_VARS) else None
+
+
+def find_runs(scene_items, dependencies):
+    """
+    Returns {start index: PictureRun} for the longest runs of items that can be recorded, `dependencies` being the
+    vars each oplist entry depends on.
+    """
+    runs = {}
+    start = 0
+    while start < len(scene_items):
+        depth = 0
+        run_deps = frozenset()
+        # Where the run last had as many restores as saves
+        end, end_deps = start, run_deps
+        i = start
+        while i < len(scene_items):
+            item_deps = _recordable(scene_items[i], depth, dependencies)
+            if item_deps is None:
+                break
+            run_deps |= item_deps
+            depth += {'save': 1, 'restore': -1}.get(scene_items[i]['type'], 0)
+            i += 1
+            if depth == 0:
+                end, end_deps = i, run_deps
+
+        if end - start >= MIN_RUN_ITEMS:
+            runs[start] = PictureRun(start, end, end_deps)
+        # After a save that isn't restored in the run, try again from the next item
+        start = max(end, start + 1)
+    return runs
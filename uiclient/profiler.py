@@ -0,0 +1,140 @@
+"""
+Records what each frame spent its time on (event dispatch, oplist evaluation, drawing each type of scene op, flushing
+the canvas, swapping, decoding packets on the protocol thread), in a ring buffer of the latest spans, and writes them
+as Chrome trace events (open in chrome://tracing or https://ui.perfetto.dev). Also keeps a histogram of the durations
+of each span and of drawing each type of scene op, over the whole run.
+"""
+import collections
+import json
+import os
+import signal
+import threading
+import time
+
+from atomic_write import atomic_write
+
+
+class Histogram:
+    # Bucket i counts durations under 2 ** i ns
+    BUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * Histogram.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, duration):
+        self.buckets[min(duration.bit_length(), Histogram.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket holding that part of the durations, in ns.
+        """
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= fraction * self.count:
+                return min(2 ** i, self.max)
+        return self.max
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total / 1e6,
+            'mean_us': self.total / self.count / 1e3 if self.count else 0,
+            'p50_us': self.percentile(0.5) / 1e3,
+            'p99_us': self.percentile(0.99) / 1e3,
+            'max_us': self.max / 1e3,
+            # Under how many us: count
+            'buckets': {f'{2 ** i / 1e3:g}': count for i, count in enumerate(self.buckets) if count},
+        }
+
+
+class Profiler:
+    MAX_SPANS = 200000
+
+    def __init__(self, path, max_spans=MAX_SPANS):
+        self.path = os.path.abspath(path)
+        self._start = time.perf_counter_ns()
+        # (name, thread id, start, duration, args), in ns. Appended to by the UI and protocol threads, deques and
+        # dicts are copied without letting other threads in, so nothing's locked
+        self._spans = collections.deque(maxlen=max_spans)
+        self._thread_names = {}
+        # By span name, and by 'draw <op type>' for each scene op drawn
+        self.histograms = collections.defaultdict(Histogram)
+        # op type: [count, ns] drawn in the current frame, see draw_op and end_draw_ops
+        self._ops = {}
+
+    @staticmethod
+    def now():
+        return time.perf_counter_ns()
+
+    def span(self, name, start, **args):
+        """
+        Records a span from start (from now()) to now.
+        """
+        duration = time.perf_counter_ns() - start
+        thread = threading.get_ident()
+        if thread not in self._thread_names:
+            self._thread_names[thread] = threading.current_thread().name
+        self._spans.append((name, thread, start, duration, args))
+        self.histograms[name].add(duration)
+
+    def draw_op(self, op_type, duration):
+        ops = self._ops.get(op_type)
+        if ops is None:
+            ops = self._ops[op_type] = [0, 0]
+        ops[0] += 1
+        ops[1] += duration
+        self.histograms['draw ' + op_type].add(duration)
+
+    def end_draw_ops(self, start):
+        """
+        Records the time spent drawing each type of op since start as one span per type, laid end to end from start
+        (a span per op would fill the ring buffer in a few frames of a big scene).
+        """
+        thread = threading.get_ident()
+        for op_type, (count, duration) in self._ops.items():
+            self._spans.append(('draw ' + op_type, thread, start, duration, {'ops': count}))
+            start += duration
+        self._ops = {}
+
+    def dump(self):
+        spans = list(self._spans)
+        histograms = dict(self.histograms)
+        events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread, 'args': {'name': name}}
+            for thread, name in list(self._thread_names.items())
+        ]
+        for name, thread, start, duration, args in spans:
+            events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': thread,
+                           'ts': (start - self._start) / 1e3, 'dur': duration / 1e3, 'args': args})
+        trace = {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'histograms': {name: histogram.to_json() for name, histogram in sorted(histograms.items())}},
+        }
+
+        try:
+            # A dump on a signal may come while the last one is being read
+            atomic_write(self.path, json.dumps(trace))
+        except OSError as e:
+            print('Failed to write the profile', e)
+            return
+
+        print(f'Wrote {len(spans)} spans to {self.path}')
+        for name, histogram in sorted(histograms.items(), key=lambda item: -item[1].total):
+            print(f'  {name:<24} {histogram.count:>8}  mean {histogram.total / histogram.count / 1e3:>9.1f}us  '
+                  f'p99 {histogram.percentile(0.99) / 1e3:>9.1f}us  max {histogram.max / 1e3:>9.1f}us')
+
+    def dump_on_signal(self, signum=signal.SIGUSR1):
+        """
+        Must be called from the main thread.
+        """
+        # Off the signal handler, which may have interrupted the main thread in the middle of a span
+        signal.signal(signum, lambda *_: threading.Thread(target=self.dump, name='Profiler').start())
@@ -0,0 +1,59 @@
+"""
+On-disk copy of the last scene (and the client-side vars) received from a server, keyed by the server's socket path.
+It's shown right away on the next launch while the server is still loading, and its hash is sent in the handshake so
+the server can skip resending a scene the client already has.
+"""
+import hashlib
+import json
+import os
+
+from atomic_write import atomic_write
+
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'boldui')
+
+
+class SceneCache:
+    def __init__(self, address, cache_dir=None):
+        self.address = os.path.abspath(address)
+        self.cache_dir = cache_dir or default_cache_dir()
+        key = hashlib.sha256(self.address.encode()).hexdigest()[:32]
+        self.path = os.path.join(self.cache_dir, f'scene-{key}.json')
+
+    def load(self):
+        """
+        Returns (scene, persistent_context), or None if nothing usable is cached for this address.
+        """
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print('Ignoring unreadable scene cache', self.path, e)
+            return None
+
+        if not isinstance(cached, dict) or cached.get('address') != self.address:
+            return None
+        scene = cached.get('scene')
+        if not isinstance(scene, dict) or 'oplist' not in scene or 'scene' not in scene:
+            return None
+        return scene, cached.get('persistent_context') or {}
+
+    def save(self, scene, persistent_context):
+        try:
+            data = json.dumps({
+                'address': self.address,
+                'scene': scene,
+                'persistent_context': persistent_context,
+            })
+        except (TypeError, ValueError, RuntimeError) as e:
+            # RuntimeError: the protocol thread changed the scene while it was being dumped, the next save will do
+            print('Failed to serialize the scene cache', e)
+            return
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            atomic_write(self.path, data)
+        except OSError as e:
+            print('Failed to write the scene cache', self.path, e)
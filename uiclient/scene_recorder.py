@@ -0,0 +1,59 @@
+"""
+Writes the scenes the client gets from the server to a JSON file (for utils/visualize_scene_graph.py), from its own
+thread so the protocol thread never waits on the disk. When scenes come faster than they can be written, only the
+latest one is.
+"""
+import json
+import os
+import threading
+
+from atomic_write import atomic_write
+
+
+class SceneRecorder:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._latest = None
+        self._closing = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='SceneRecorder', daemon=True)
+        self._thread.start()
+
+    def record(self, scene):
+        """
+        The scene mustn't change afterwards (UIClient doesn't edit scenes, patches make new ones).
+        """
+        with self._condition:
+            self._latest = scene
+            self._condition.notify()
+
+    def close(self):
+        """
+        Writes the scene still waiting, if any.
+        """
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._latest is None and not self._closing:
+                    self._condition.wait()
+                scene, self._latest = self._latest, None
+            if scene is None:
+                return
+            self._write(scene)
+
+    def _write(self, scene):
+        try:
+            data = json.dumps(scene)
+        except (TypeError, ValueError) as e:
+            print('Failed to serialize the scene to record', e)
+            return
+
+        try:
+            atomic_write(self.path, data)
+        except OSError as e:
+            print('Failed to record the scene', e)
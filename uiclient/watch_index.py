@@ -0,0 +1,48 @@
+"""
+The scene's watches, indexed when the scene loads, so checking them after an event, a resize or a var update doesn't
+evaluate the whole scene oplist and scan every scene item. Their conds are evaluated on their own: only the entries
+the conds read, and of those only the ones depending on vars that changed (a resize doesn't lay out the scene for a
+watch reading a var set by the server).
+"""
+from oplist_compiler import CompiledOplist, HandlerOplist, subgraph
+
+
+class WatchIndex:
+    def __init__(self, scene_items, oplist, measure_text):
+        self.watches = [item for item in scene_items if item['type'] == 'watch']
+        # Received scenes are never changed (patches make a new one), the handlers made later see this same oplist
+        self._oplist = oplist
+        self._measure_text = measure_text
+        # Made the first time a watch fires
+        self._handler_oplists = [None] * len(self.watches)
+
+        # A cond past the end of the oplist fails when the watches are checked, like it always did
+        conds = [watch['cond'] for watch in self.watches]
+        cond_oplist, indices = subgraph(oplist, [cond for cond in conds if isinstance(cond, int) and
+                                                 0 <= cond < len(oplist)])
+        self._conds = [indices.get(watch['cond']) for watch in self.watches]
+        self._evaluate_conds = CompiledOplist(cond_oplist, measure_text)
+
+    @property
+    def stats(self):
+        return self._evaluate_conds.stats
+
+    def conds(self, context):
+        """
+        Returns the value of each watch's cond.
+        """
+        results = self._evaluate_conds(context)
+        conds = []
+        for watch, index in zip(self.watches, self._conds):
+            if index is None:
+                raise IndexError(f'Watch {watch["id"]} reads entry #{watch["cond"]} of the oplist')
+            conds.append(results[index])
+        return conds
+
+    def handler_results(self, i, context):
+        """
+        Returns the results of the oplist for the handler of watch i (None for the entries it doesn't read).
+        """
+        if self._handler_oplists[i] is None:
+            self._handler_oplists[i] = HandlerOplist(self._oplist, self.watches[i]['handler'], self._measure_text)
+        return self._handler_oplists[i](context)
@@ -0,0 +1 @@
+../boldui/wire.py
\ No newline at end of file
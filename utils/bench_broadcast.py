@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Measure the server-side cost of one scene update / one SET_VAR when mirroring an app to 1..64 clients.
+"""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from boldui import Ops, Oplist, ProtocolServer, var, wire  # noqa: E402
+
+UPDATES = 200
+
+
+def make_scene(label):
+    oplist = Oplist()
+    scene = [Ops.clear(0xff000000)]
+    for i in range(200):
+        scene.append(Ops.rect(
+            (oplist.append(i), oplist.append(var('height') * 0.1), oplist.append(var('width') - i), oplist.append(40)),
+            oplist.append(0xff000000 | i),
+        ))
+    scene.append(Ops.text(oplist.append(label), oplist.append(10), oplist.append(10), oplist.append(14),
+                          oplist.append(0xffffffff)))
+    return {'oplist': oplist.to_list(), 'scene': scene, 'vars': {}}
+
+
+def client(address, version, connected):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    sock.recv(8)
+    sock.send(wire.PROTOCOL_MAGIC + bytes([version]))
+    connected.append(sock)
+    while sock.recv(1 << 16):
+        pass
+
+
+def bench(client_count, version):
+    tmpdir = tempfile.mkdtemp()
+    address = os.path.join(tmpdir, 'bench.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(address)
+    listener.listen(client_count)
+
+    # Flushed by hand below, so every update is sent on its own instead of being coalesced
+    server = ProtocolServer(os.path.join(tmpdir, 'unused.sock'), max_clients=client_count, listen_fd=listener.fileno(),
+                            frame_budget=3600)
+    server.scene = make_scene('initial')
+    serve_thread = threading.Thread(target=server.serve)
+    serve_thread.start()
+
+    connected = []
+    for _ in range(client_count):
+        threading.Thread(target=client, args=(address, version, connected), daemon=True).start()
+    while len(server.clients) < client_count:
+        time.sleep(0.01)
+
+    scenes = [make_scene(f'update {i}') for i in range(UPDATES)]
+    start = time.perf_counter()
+    for scene in scenes:
+        server.scene = scene
+        server.flush()
+    scene_time = (time.perf_counter() - start) / UPDATES
+
+    start = time.perf_counter()
+    for i in range(UPDATES):
+        server.set_remote_var('d:0', 'n', i)
+        server.flush()
+    var_time = (time.perf_counter() - start) / UPDATES
+
+    for sock in connected:
+        sock.shutdown(socket.SHUT_RDWR)
+    serve_thread.join()
+    listener.close()
+    return scene_time, var_time
+
+
+def main():
+    print(f'{"clients":>8} {"version":>8} | {"scene update":>14} {"per client":>12} | {"set var":>10} {"per client":>12}')
+    for version in (wire.PROTOCOL_JSON, wire.PROTOCOL_BINARY):
+        for client_count in (1, 2, 4, 8, 16, 32, 64):
+            scene_time, var_time = bench(client_count, version)
+            print(f'{client_count:>8} {version:>8} | {scene_time * 1e6:>12.1f}us {scene_time / client_count * 1e6:>10.1f}us'
+                  f' | {var_time * 1e6:>8.1f}us {var_time / client_count * 1e6:>10.1f}us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Throughput of the packet framing layer with 10 MB scenes, against the old `packet += sock.recv(...)` loop.
+"""
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from boldui import wire  # noqa: E402
+
+PACKET_SIZE = 10 * 1024 * 1024
+PACKETS = 20
+
+
+def old_send(sock, header, payload):
+    packet = header + payload
+    sock.sendall(len(packet).to_bytes(4, 'big') + packet)
+
+
+def old_recv(sock):
+    packet = b''
+    packet_length = sock.recv(4)
+    if not packet_length:
+        return None
+
+    packet_length = int.from_bytes(packet_length, 'big')
+    while len(packet) < packet_length:
+        packet += sock.recv(packet_length - len(packet))
+    return packet
+
+
+def new_send(sock, header, payload):
+    wire.send_packet(sock, header, payload)
+
+
+def bench(send, make_reader):
+    server_sock, client_sock = socket.socketpair()
+    header = b'\x00\x00\x00\x00'
+    payload = os.urandom(PACKET_SIZE - len(header))
+
+    def sender():
+        for _ in range(PACKETS):
+            send(server_sock, header, payload)
+        server_sock.close()
+
+    thread = threading.Thread(target=sender)
+    read_packet = make_reader(client_sock)
+    start = time.perf_counter()
+    thread.start()
+    received = 0
+    while (packet := read_packet()) is not None:
+        assert len(packet) == PACKET_SIZE
+        received += len(packet)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    client_sock.close()
+    return received / elapsed / 1024 / 1024
+
+
+def main():
+    old = bench(old_send, lambda sock: lambda: old_recv(sock))
+    new = bench(new_send, lambda sock: wire.PacketReader(sock).read_packet)
+    print(f'{PACKETS} x {PACKET_SIZE // 1024 // 1024} MB packets')
+    print(f'old (concatenating): {old:>8.1f} MB/s')
+    print(f'new (recv_into):     {new:>8.1f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
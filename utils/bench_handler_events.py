@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Per-event latency of continuous wheel input over the ListViews of example_framework_listview.py: the scroll handlers'
+oplists evaluated with UIClient.resolve_oplist on a merged copy of the context (like every event used to) against
+HandlerOplist, then the whole of UIClient.handle_scroll and flush_input for each event (the setVar, the watches it
+wakes up) with replies dropped. Takes the number of events as argument.
+"""
+import importlib.util
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'uiclient'))
+
+from boldui.app import App  # noqa: E402
+from main import UIClient  # noqa: E402
+
+WIDTH, HEIGHT = 1280, 720
+
+
+class NoServer:
+    def set_remote_var(self, *args):
+        pass
+
+
+def listview_scene(directory):
+    spec = importlib.util.spec_from_file_location(
+        'example_framework_listview', os.path.join(os.path.dirname(__file__), '..', 'example_framework_listview.py'))
+    example = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(example)
+    model = example.Model.open_db(os.path.join(directory, 'example_app.db'))
+    app = App(lambda: example.MainPage(model), durable_model=model)
+    # Builds push the vars they create to the server, there's none
+    app.server = NoServer()
+    return app.rebuild()
+
+
+def percentiles(times):
+    times = sorted(times)
+    return (f'median {times[len(times) // 2] * 1e6:7.1f}us  p99 {times[len(times) * 99 // 100] * 1e6:7.1f}us  '
+            f'{len(times) / sum(times):8.0f} events/s')
+
+
+def main():
+    event_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    directory = tempfile.mkdtemp()
+    try:
+        scene = listview_scene(directory)
+
+        # UIClient connects to a server, this one never answers
+        server = socket.socket(socket.AF_UNIX)
+        server.bind(os.path.join(directory, 'server.sock'))
+        server.listen(1)
+        ui = UIClient(os.path.join(directory, 'server.sock'), use_scene_cache=False)
+        # Its protocol thread fails when the server goes away
+        threading.excepthook = lambda args: None
+        ui._send_replies = lambda replies: None
+        ui.resize(WIDTH, HEIGHT)
+        ui.scene = scene
+        # Like the client does with the var definitions the server sends
+        for name, definition in scene['vars'].items():
+            ui.persistent_context[name] = {'int': 0, 'float': 0.0, 'string': ''}[definition['type']]
+        ui._show_latest_scene()
+        ui.event_handlers = ui._resolve_items(ui.evaluate_oplist(ui.context), ui.context)[1]
+
+        # Alternating between the two lists, scrolling down
+        points = [(WIDTH // 4 + WIDTH // 2 * (i % 2), HEIGHT // 2) for i in range(event_count)]
+        scroll_handlers = [handler for handler in ui.event_handlers if handler['events'] & 2]
+
+        interpreted, compiled = [], []
+        for x, y in points:
+            extra_context = {'event_x': x, 'event_y': y, 'scroll_x': 0, 'scroll_y': -1}
+            handlers = [handler for handler in scroll_handlers if handler['rect'][0] <= x <= handler['rect'][2] and
+                        handler['rect'][1] <= y <= handler['rect'][3]]
+
+            start = time.perf_counter()
+            merged_context = {**ui.context, **extra_context}
+            expected = [UIClient.resolve_oplist(handler['item']['oplist'], merged_context) for handler in handlers]
+            interpreted.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            context = ui._event_context(extra_context)
+            [ui._handler_oplist(handler['item'])(context) for handler in handlers]
+            compiled.append(time.perf_counter() - start)
+
+            # Same context for both, time moved on in between
+            for handler, expected_results in zip(handlers, expected):
+                results = ui._handler_oplist(handler['item'])(merged_context)
+                assert all(result is None or result == expected_result
+                           for result, expected_result in zip(results, expected_results))
+
+        entries = [len(handler['item']['oplist']) for handler in scroll_handlers]
+        evaluated = [ui._handler_oplist(handler['item']).evaluated for handler in scroll_handlers]
+        print(f'{len(scroll_handlers)} scroll handlers, {sum(entries)} oplist entries, {sum(evaluated)} evaluated')
+        print(f'resolve_oplist:  {percentiles(interpreted)}')
+        print(f'HandlerOplist:   {percentiles(compiled)}')
+
+        whole = []
+        for x, y in points:
+            start = time.perf_counter()
+            ui.handle_scroll(x, y, 0, -1)
+            ui.flush_input()
+            whole.append(time.perf_counter() - start)
+        print(f'handle_scroll + flush_input: {percentiles(whole)}')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Hit-testing throughput with 10k event handlers, like a long list with four buttons per row on top of a scroll area:
+finding the handlers under the pointer by scanning all of them against the grid index, building the grid included.
+Takes the number of handlers and of events as arguments.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'uiclient'))
+
+from hit_grid import HitGrid  # noqa: E402
+
+WIDTH, HEIGHT = 1280, 720
+ROW_HEIGHT = 24
+MOUSE_DOWN_EVT = 1
+
+
+def make_handlers(count):
+    handlers = [{'rect': (0, 0, WIDTH, HEIGHT), 'events': MOUSE_DOWN_EVT, 'oplist': [], 'handler': []}]
+    # Scrolled half way, most rows are outside the window
+    scroll = (count - 1) // 4 * ROW_HEIGHT // 2
+    for i in range(count - 1):
+        row, button = divmod(i, 4)
+        top = row * ROW_HEIGHT - scroll
+        left = button * WIDTH // 4
+        handlers.append({'rect': (left, top, left + WIDTH // 4 - 1, top + ROW_HEIGHT - 1), 'events': MOUSE_DOWN_EVT,
+                         'oplist': [], 'handler': []})
+    return handlers
+
+
+def linear(handlers, x, y):
+    # What _handle_event_generic did before the grid
+    return [handler for handler in handlers
+            if handler['rect'][0] <= x <= handler['rect'][2] and handler['rect'][1] <= y <= handler['rect'][3]]
+
+
+def main():
+    handler_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    event_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+    handlers = make_handlers(handler_count)
+    rng = random.Random(0)
+    # Points outside the window (the mouse is captured while a button is held) go through all the handlers either way
+    points = [(rng.uniform(0, WIDTH - 1), rng.uniform(0, HEIGHT - 1)) for _ in range(event_count)]
+
+    start = time.perf_counter()
+    expected = [linear(handlers, x, y) for x, y in points]
+    linear_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    grid = HitGrid(handlers, WIDTH, HEIGHT)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    hits = [grid.query(x, y) for x, y in points]
+    grid_time = time.perf_counter() - start
+    assert hits == expected, 'the grid found different handlers than the linear scan'
+
+    # A new frame comes with new handlers, worst case one event per frame
+    start = time.perf_counter()
+    for x, y in points[:200]:
+        HitGrid(handlers, WIDTH, HEIGHT).query(x, y)
+    rebuild_time = (time.perf_counter() - start) / 200
+
+    print(f'{handler_count} handlers, {event_count} events')
+    print(f'linear scan:          {event_count / linear_time:10.0f} events/s')
+    print(f'grid:                 {event_count / grid_time:10.0f} events/s, built in {build_time * 1000:.1f}ms')
+    print(f'grid rebuilt per event: {1 / rebuild_time:8.0f} events/s')
+    print(f'handlers hit per event: {sum(map(len, hits)) / event_count:.2f}, topmost only: 1')
+
+
+if __name__ == '__main__':
+    main()
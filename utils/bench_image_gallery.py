@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Frame times while a gallery of 200 big JPEGs appears: the first frame of the gallery scene and the following ones, as
+fast as the client can draw, until every image has been decoded. Takes the number of images and their size (default
+200 4000x3000).
+"""
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'uiclient'))
+
+import skia  # noqa: E402
+from main import UIClient  # noqa: E402
+
+WIDTH, HEIGHT = 1280, 720
+TIMEOUT = 120
+
+
+def make_jpeg(path, width, height):
+    surface = skia.Surface(width, height)
+    canvas = surface.getCanvas()
+    canvas.drawPaint(skia.Paint(Shader=skia.GradientShader.MakeLinear(
+        [(0, 0), (width, height)], [0xff2060a0, 0xffe0a040])))
+    for i in range(200):
+        x, y = (i * 7919) % width, (i * 104729) % height
+        canvas.drawCircle(x, y, 20 + i % 150, skia.Paint(Color=0x40ffffff ^ (i * 0x10203), AntiAlias=True))
+    surface.makeImageSnapshot().save(path, skia.kJPEG)
+
+
+def gallery_scene(paths):
+    columns = 20
+    cell_width, cell_height = WIDTH // columns, HEIGHT // ((len(paths) + columns - 1) // columns)
+    oplist = [0xff000000]
+    scene = [{'type': 'clear', 'color': 0}]
+    for i, path in enumerate(paths):
+        left, top = (i % columns) * cell_width, (i // columns) * cell_height
+        rect = []
+        for value in (left + 2, top + 2, left + cell_width - 2, top + cell_height - 2):
+            rect.append(len(oplist))
+            oplist.append(value)
+        scene.append({'type': 'image', 'uri': path, 'rect': rect})
+    return {'oplist': oplist, 'scene': scene}
+
+
+def main():
+    image_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    image_width, image_height = (int(arg) for arg in sys.argv[2:4]) if len(sys.argv) > 3 else (4000, 3000)
+
+    directory = tempfile.mkdtemp()
+    try:
+        make_jpeg(os.path.join(directory, 'photo.jpg'), image_width, image_height)
+        paths = []
+        for i in range(image_count):
+            paths.append(os.path.join(directory, f'photo{i}.jpg'))
+            shutil.copyfile(os.path.join(directory, 'photo.jpg'), paths[-1])
+
+        # UIClient connects to a server, this one never answers
+        server = socket.socket(socket.AF_UNIX)
+        server.bind(os.path.join(directory, 'server.sock'))
+        server.listen(1)
+        ui = UIClient(os.path.join(directory, 'server.sock'), use_scene_cache=False)
+        # Its protocol thread fails when the server goes away
+        threading.excepthook = lambda args: None
+        ui.resize(WIDTH, HEIGHT)
+        surface = skia.Surface(WIDTH, HEIGHT)
+
+        ui.scene = gallery_scene(paths)
+        frame_times = []
+        start = time.perf_counter()
+        while len(ui.image_cache) + len(ui._failed_images) < image_count:
+            frame_start = time.perf_counter()
+            ui.draw(surface.getCanvas())
+            surface.flushAndSubmit()
+            frame_times.append(time.perf_counter() - frame_start)
+            assert frame_start - start < TIMEOUT, 'images took too long to decode'
+        all_decoded = time.perf_counter() - start
+
+        print(f'{image_count} {image_width}x{image_height} JPEGs ({os.path.getsize(paths[0]) / 2 ** 20:.1f}MB each): '
+              f'all decoded after {all_decoded:.2f}s and {len(frame_times)} frames, first frame '
+              f'{frame_times[0] * 1000:.1f}ms, worst {max(frame_times) * 1000:.1f}ms, '
+              f'median {sorted(frame_times)[len(frame_times) // 2] * 1000:.1f}ms, '
+              f'{ui.image_cache.nbytes / 2 ** 20:.1f}MB of pixels kept')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
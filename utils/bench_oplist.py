@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Compare evaluating a scene oplist every frame with UIClient.resolve_oplist (interpreted) and with CompiledOplist, on
+the oplist of example_raw_stress.py (500 rects) and bigger ones, where every 50th rect is animated with `time`.
+CompiledOplist is measured for frames where only `time` changes and for frames during a resize, both before its
+plans get compiled (closures) and after. Also checks they all give the same results.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'uiclient'))
+
+from boldui import Oplist, var  # noqa: E402
+from main import UIClient  # noqa: E402
+import oplist_compiler  # noqa: E402
+
+
+def make_oplist(rect_count):
+    # Same as example_raw_stress.py
+    rng = random.Random(0)
+    oplist = Oplist()
+    for i in range(rect_count):
+        w = rng.random()
+        h = rng.random()
+        x = rng.random() * (1 - w)
+        y = rng.random() * (1 - h)
+        if i % 50 == 0:
+            oplist.append(var('width') * x + var('time') * 10)
+        else:
+            oplist.append(var('width') * x)
+        oplist.append(var('height') * y)
+        oplist.append(var('width') * (w + x))
+        oplist.append(var('height') * (h + y))
+        oplist.append(rng.randint(0x000000, 0xffffff) | 0xff000000)
+    return oplist.to_list()
+
+
+def bench(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def bench_frames(evaluate, contexts, expected):
+    best = float('inf')
+    for context, results in zip(contexts, expected):
+        start = time.perf_counter()
+        assert evaluate(context) == results
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, evaluate.last_evaluated
+
+
+def main():
+    print(f'{"rects":>6} {"entries":>8} | {"interpreted":>11} | {"time only":>9} {"compiled":>9} {"evaluated":>9} | '
+          f'{"resize":>9} {"compiled":>9} {"evaluated":>9}')
+    for rect_count in [int(arg) for arg in sys.argv[1:]] or [500, 5000]:
+        oplist = make_oplist(rect_count)
+        frames = max(20, 200000 // len(oplist))
+        animation = [{'width': 1280, 'height': 720, 'time': i / 60} for i in range(frames)]
+        resize = [{'width': 1280 + i, 'height': 720 + i, 'time': 1.0} for i in range(frames)]
+        expected_animation = [UIClient.resolve_oplist(oplist, context) for context in animation]
+        expected_resize = [UIClient.resolve_oplist(oplist, context) for context in resize]
+        interpreted = bench(lambda: UIClient.resolve_oplist(oplist, animation[0]), frames)
+
+        row = []
+        for contexts, expected in ((animation, expected_animation), (resize, expected_resize)):
+            oplist_compiler._chunk_cache.clear()
+            evaluate = oplist_compiler.CompiledOplist(oplist, UIClient.measure_text)
+            evaluate(contexts[-1])
+            # Keep the plans from being compiled at first
+            oplist_compiler.WARMUP_CALLS = float('inf')
+            closures, evaluated = bench_frames(evaluate, contexts, expected)
+            oplist_compiler.WARMUP_CALLS = 0
+            for plan in evaluate._plans.values():
+                while plan.next_chunk < len(plan.chunks):
+                    evaluate._compile_next_chunk(plan)
+            compiled, _ = bench_frames(evaluate, contexts, expected)
+            row.append(f'{closures:>7.3f}ms {compiled:>7.3f}ms {evaluated:>9}')
+
+        print(f'{rect_count:>6} {len(oplist):>8} | {interpreted:>9.3f}ms | {row[0]} | {row[1]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Compare the numpy evaluator (VectorizedOplist) with UIClient.resolve_oplist and CompiledOplist on stress scenes of 1k,
+10k and 100k oplist entries, for frames during a resize (when almost every entry has to be computed again). Also
+shows what loading a scene costs each evaluator, and checks they all give the same results.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'uiclient'))
+
+from bench_oplist import make_oplist  # noqa: E402
+from main import UIClient  # noqa: E402
+import oplist_compiler  # noqa: E402
+import oplist_vectorized  # noqa: E402
+
+
+def bench_frames(evaluate, contexts, expected):
+    best = float('inf')
+    for context, results in zip(contexts, expected):
+        start = time.perf_counter()
+        assert evaluate(context) == results
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def load(evaluator, oplist, context):
+    start = time.perf_counter()
+    evaluate = evaluator(oplist, UIClient.measure_text)
+    evaluate(context)
+    return evaluate, (time.perf_counter() - start) * 1000
+
+
+def main():
+    if oplist_vectorized.np is None:
+        sys.exit('numpy is not installed')
+
+    print(f'{"entries":>8} {"evaluated":>9} | {"interpreted":>11} | {"compiled":>9} {"load":>9} | '
+          f'{"numpy":>9} {"load":>9} {"levels":>6}')
+    for entry_count in [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]:
+        # ~9 entries per rect
+        oplist = make_oplist(max(1, entry_count // 9))
+        frames = max(10, 500000 // len(oplist))
+        contexts = [{'width': 1280 + i, 'height': 720 + i, 'time': 1.0} for i in range(frames + 1)]
+        expected = [UIClient.resolve_oplist(oplist, context) for context in contexts]
+        interpreted = min(bench_frames(lambda context: UIClient.resolve_oplist(oplist, context), [context], [results])
+                          for context, results in zip(contexts, expected))
+
+        oplist_compiler._chunk_cache.clear()
+        compiled, compiled_load = load(oplist_compiler.CompiledOplist, oplist, contexts[0])
+        bench_frames(compiled, contexts[1:], expected[1:])
+        # Compile the whole plan before measuring
+        oplist_compiler.WARMUP_CALLS = 0
+        for plan in compiled._plans.values():
+            while plan.next_chunk < len(plan.chunks):
+                compiled._compile_next_chunk(plan)
+        compiled_time = bench_frames(compiled, reversed(contexts[1:]), reversed(expected[1:]))
+
+        vectorized, vectorized_load = load(oplist_vectorized.VectorizedOplist, oplist, contexts[0])
+        vectorized_time = bench_frames(vectorized, contexts[1:], expected[1:])
+        levels = len(vectorized._plan.levels)
+
+        print(f'{len(oplist):>8} {compiled.last_evaluated:>9} | {interpreted:>9.3f}ms | '
+              f'{compiled_time:>7.3f}ms {compiled_load:>7.1f}ms | '
+              f'{vectorized_time:>7.3f}ms {vectorized_load:>7.1f}ms {levels:>6}')
+
+
+if __name__ == '__main__':
+    main()
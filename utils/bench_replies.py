@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Replies per second through HANDLER_REPLY encoding (client) and decoding (server), old per-item code vs wire.py.
+"""
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from boldui import wire  # noqa: E402
+
+BATCH = 64
+
+
+def old_encode(replies):
+    formatted = []
+    for reply_id, values in replies:
+        formatted_data = reply_id.to_bytes(4, 'big')
+        for val in values:
+            if isinstance(val, int):
+                formatted_data += b'\x00'
+                formatted_data += val.to_bytes(8, 'big', signed=True)
+            elif isinstance(val, float):
+                formatted_data += b'\x01'
+                formatted_data += struct.pack('>d', val)
+        formatted.append(formatted_data)
+    return len(formatted).to_bytes(2, 'big') + b''.join(
+        ((len(reply) - 4).to_bytes(2, 'big') + reply) for reply in formatted
+    )
+
+
+def old_decode(data):
+    replies = []
+    reply_count = int.from_bytes(data[:2], 'big')
+    data = data[2:]
+    for i in range(reply_count):
+        reply_len = int.from_bytes(data[:2], 'big')
+        reply_id = int.from_bytes(data[2:6], 'big')
+        reply_data = data[6:6 + reply_len]
+        data = data[6 + reply_len:]
+        data_array = []
+        while reply_data:
+            item_type = reply_data[0]
+            if item_type == 0:
+                data_array.append(int.from_bytes(reply_data[1:9], 'big', signed=True))
+                reply_data = reply_data[9:]
+            elif item_type == 1:
+                data_array.append(struct.unpack('>d', reply_data[1:9])[0])
+                reply_data = reply_data[9:]
+        replies.append((reply_id, data_array))
+    return replies
+
+
+def rate(fn, arg):
+    iterations = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < 1:
+        for _ in range(100):
+            fn(arg)
+        iterations += 100
+    return iterations * BATCH / (time.perf_counter() - start)
+
+
+def main():
+    # A scroll reply: event_x, event_y, scroll_x, scroll_y, time
+    replies = [(i, [320, 200 + i, 0, -1, 12.5 + i]) for i in range(BATCH)]
+    payload = old_encode(replies)
+    assert wire.encode_replies(replies) == payload
+    assert wire.decode_replies(payload) == old_decode(payload) == replies
+
+    print(f'{BATCH} scroll replies per packet')
+    print(f'encode: old {rate(old_encode, replies):>12,.0f}/s   new {rate(wire.encode_replies, replies):>12,.0f}/s')
+    print(f'decode: old {rate(old_decode, payload):>12,.0f}/s   new {rate(wire.decode_replies, payload):>12,.0f}/s')
+
+
+if __name__ == '__main__':
+    main()
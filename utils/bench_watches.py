@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Watch evaluation time while dragging the window's size, for the scene of example_raw_stress.py (500 rects laid out
+with width and height) with 100 watches: half of them on the layout (like the watches of ListViews), half on a var the
+server sets. Compares evaluating the whole scene oplist and scanning the scene for watches (like update_watches used
+to) with WatchIndex, and checks they fire the same watches. Takes the number of rects and of watches as arguments.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'uiclient'))
+
+from boldui import Oplist, Ops, var  # noqa: E402
+from main import UIClient  # noqa: E402
+from oplist_compiler import CompiledOplist  # noqa: E402
+from watch_index import WatchIndex  # noqa: E402
+
+FRAMES = 300
+
+
+def make_scene(rect_count, watch_count):
+    rng = random.Random(0)
+    oplist = Oplist()
+    scene = [Ops.clear(0xff000000)]
+    for _ in range(rect_count):
+        w, h = rng.random(), rng.random()
+        x, y = rng.random() * (1 - w), rng.random() * (1 - h)
+        scene.append(Ops.rect((oplist.append(var('width') * x), oplist.append(var('height') * y),
+                               oplist.append(var('width') * (w + x)), oplist.append(var('height') * (h + y))),
+                              oplist.append(rng.randint(0x000000, 0xffffff) | 0xff000000)))
+    for i in range(watch_count):
+        if i % 2:
+            cond = var('width') * rng.random() + var('height') * rng.random() > 800
+        else:
+            cond = var('items_loaded') < i
+        scene.append(Ops.watch_var(i, oplist.append(cond), True,
+                                   [Ops.reply(i, [oplist.append(var('width')), oplist.append(var('items_loaded'))])]))
+    return {'oplist': oplist.to_list(), 'scene': scene}
+
+
+def fire_all(conds, watches, blocked):
+    fired = []
+    for watch, cond in zip(watches, conds):
+        if watch['id'] not in blocked and cond:
+            fired.append(watch['id'])
+            blocked.add(watch['id'])
+    return fired
+
+
+def main():
+    rect_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    watch_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    scene = make_scene(rect_count, watch_count)
+    contexts = [{'width': 640 + i * 3, 'height': 480 + i * 2, 'items_loaded': 20 + i // 10, 'time': 0}
+                for i in range(FRAMES)]
+
+    evaluate = CompiledOplist(scene['oplist'], UIClient.measure_text)
+    blocked = set()
+    scanned, scanned_fired = [], []
+    for context in contexts:
+        start = time.perf_counter()
+        op_results = evaluate(context)
+        watches = [op for op in scene['scene'] if op['type'] == 'watch']
+        scanned_fired.append(fire_all([op_results[op['cond']] for op in watches], watches, blocked))
+        scanned.append(time.perf_counter() - start)
+    evaluated = evaluate.stats['evaluated'] / FRAMES
+
+    start = time.perf_counter()
+    watch_index = WatchIndex(scene['scene'], scene['oplist'], UIClient.measure_text)
+    build_time = time.perf_counter() - start
+    blocked = set()
+    indexed, indexed_fired = [], []
+    for context in contexts:
+        start = time.perf_counter()
+        indexed_fired.append(fire_all(watch_index.conds(context), watch_index.watches, blocked))
+        indexed.append(time.perf_counter() - start)
+    assert indexed_fired == scanned_fired, 'the index fired different watches'
+
+    def median(times):
+        return sorted(times)[len(times) // 2] * 1e6
+
+    print(f'{rect_count} rects, {watch_count} watches, {len(scene["oplist"])} oplist entries, {FRAMES} resize steps, '
+          f'{sum(map(len, indexed_fired))} watches fired')
+    print(f'whole oplist + scan: median {median(scanned):8.1f}us  {evaluated:7.0f} entries evaluated per step')
+    print(f'WatchIndex:          median {median(indexed):8.1f}us  '
+          f'{watch_index.stats["evaluated"] / FRAMES:7.0f} entries evaluated per step  '
+          f'(built in {build_time * 1000:.1f}ms)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+A one second trackpad fling (wheel events at 60 frames per second, many per frame at first) over a scroll handler that
+replies to the server, which rebuilds its scene for every batch of replies like App does. Compares sending a reply
+packet per wheel event (like the client used to) with adding up each frame's wheel events (UIClient.flush_input):
+packets per second, replies, and server rebuilds. Takes the number of wheel events in the fling's first frame.
+"""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'uiclient'))
+
+import skia  # noqa: E402
+from boldui import Oplist, Ops, ProtocolServer, var  # noqa: E402
+from main import UIClient  # noqa: E402
+
+WIDTH, HEIGHT = 1280, 720
+FPS = 60
+MOUSE_SCROLL_EVT = 1 << 1
+SCROLL_REPLY = 1
+
+
+def make_scene(scroll):
+    oplist = Oplist()
+    scene = [Ops.clear(0xff000000)]
+    for i in range(50):
+        top = i * 40 - scroll
+        scene.append(Ops.rect((oplist.append(0), oplist.append(top), oplist.append(var('width')),
+                               oplist.append(top + 38)), oplist.append(0xff203040 + i)))
+    handler_oplist = Oplist()
+    # Like EventHandler(on_scroll=...) in the framework
+    handler = [Ops.reply(SCROLL_REPLY, [handler_oplist.append(var(name))
+                                        for name in ('event_x', 'event_y', 'scroll_x', 'scroll_y', 'time')])]
+    scene.append(Ops.event_handler((oplist.append(0), oplist.append(0), oplist.append(var('width')),
+                                    oplist.append(var('height'))), MOUSE_SCROLL_EVT, handler, handler_oplist.to_list()))
+    return {'oplist': oplist.to_list(), 'scene': scene, 'vars': {}}
+
+
+def fling(first_frame_events, coalesce):
+    directory = tempfile.mkdtemp()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(os.path.join(directory, 'bench.sock'))
+    listener.listen(1)
+
+    counts = {'replies': 0, 'rebuilds': 0, 'scroll': 0}
+
+    def build():
+        counts['rebuilds'] += 1
+        return make_scene(counts['scroll'])
+
+    def on_reply(reply_id, data):
+        counts['replies'] += 1
+        counts['scroll'] -= data[3]
+        server.refresh_scene()
+
+    server = ProtocolServer(os.path.join(directory, 'unused.sock'), reply_handler=on_reply,
+                            listen_fd=listener.fileno())
+    server.scene = build
+    threading.Thread(target=server.serve, daemon=True).start()
+
+    ui = UIClient(os.path.join(directory, 'bench.sock'), use_scene_cache=False)
+    ui.resize(WIDTH, HEIGHT)
+    surface = skia.Surface(WIDTH, HEIGHT)
+    while not ui.has_scene:
+        time.sleep(0.01)
+    ui.draw(surface.getCanvas())
+    counts['rebuilds'] = 0
+
+    start = time.perf_counter()
+    for frame in range(FPS):
+        frame_start = time.perf_counter()
+        # Slowing down, a few events per frame at the end
+        for _ in range(max(1, round(first_frame_events * 0.95 ** frame))):
+            ui.handle_scroll(WIDTH // 2, HEIGHT // 2, 0, -1)
+            if not coalesce:
+                ui.flush_input()
+        ui.flush_input()
+        ui.draw(surface.getCanvas())
+        time.sleep(max(0.0, 1 / FPS - (time.perf_counter() - frame_start)))
+    elapsed = time.perf_counter() - start
+    # Let the server catch up
+    time.sleep(0.5)
+    return ui.input_stats, counts, elapsed
+
+
+def main():
+    first_frame_events = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    # Both the client's and the server's protocol threads go on until the process exits
+    threading.excepthook = lambda args: None
+    for coalesce in (False, True):
+        stats, counts, elapsed = fling(first_frame_events, coalesce)
+        print(f'{"per frame" if coalesce else "per event":>9}: {stats["wheel_events"]} wheel events, '
+              f'{stats["scroll_dispatches"]} dispatches, {stats["reply_packets"] / elapsed:.0f} reply packets/s, '
+              f'{counts["replies"]} replies handled by the server, {counts["rebuilds"]} server rebuilds, '
+              f'scrolled {-counts["scroll"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Compare the JSON and binary (protocol version 2) scene encodings: size on the wire and encode/decode round-trip time.
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from boldui import Ops, Oplist, var, wire  # noqa: E402
+
+
+def make_scene(rect_count):
+    # Same shape as example_raw_stress.py, plus a text label per rect
+    rng = random.Random(0)
+    oplist = Oplist()
+    scene = [Ops.clear(0xff000000)]
+    for i in range(rect_count):
+        w = rng.random()
+        h = rng.random()
+        x = rng.random() * (1 - w)
+        y = rng.random() * (1 - h)
+        color = rng.randint(0x000000, 0xffffff) | 0xff000000
+        rect = (
+            oplist.append(var('width') * x),
+            oplist.append(var('height') * y),
+            oplist.append(var('width') * (w + x)),
+            oplist.append(var('height') * (h + y)),
+        )
+        scene.append(Ops.rect(rect, oplist.append(color)))
+        scene.append(Ops.text(
+            oplist.append(f'Item #{i}'), rect[0], rect[1], oplist.append(14), oplist.append(0xffffffff),
+        ))
+    return {'oplist': oplist.to_list(), 'scene': scene, 'vars': {}}
+
+
+def bench(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000]
+    print(f'{"rects":>8} {"ops":>8} | {"codec":>6} {"bytes":>10} {"encode":>10} {"decode":>10}')
+    for size in sizes:
+        scene = make_scene(size)
+        op_count = len(scene['oplist']) + len(scene['scene'])
+        repeat = max(3, 30000 // op_count)
+
+        json_bytes = json.dumps(scene).encode()
+        wire_bytes = wire.encode(scene)
+        assert wire.decode(wire_bytes) == json.loads(json_bytes)
+
+        for name, data, encode, decode in (
+            ('json', json_bytes, lambda: json.dumps(scene).encode(), lambda: json.loads(json_bytes)),
+            ('binary', wire_bytes, lambda: wire.encode(scene), lambda: wire.decode(wire_bytes)),
+        ):
+            print(f'{size:>8} {op_count:>8} | {name:>6} {len(data):>10} '
+                  f'{bench(encode, repeat):>8.2f}ms {bench(decode, repeat):>8.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Prints a compression dictionary made from the current op schemas, in the form of wire.COMPRESSION_DICTIONARY: a
+sample scene with one op of each schema, as both encodings write it. The one in wire.py is frozen, since both ends
+must have the same bytes, so a new one needs a new feature bit.
+"""
+import base64
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from boldui import wire  # noqa: E402
+
+LINE_LENGTH = 112
+
+
+def sample_scene():
+    # With the kind of values real scenes have in their fields
+    samples = {wire._IDX: 1, wire._IDX_LIST: [0, 1, 2, 3], wire._STR: 'width', wire._VALUE: 0}
+    ops = [
+        {'type': op_type, **{name: samples[kind] for name, kind in fields}}
+        for op_type, fields in wire.OP_SCHEMAS
+    ]
+    first_scene_op = next(i for i, (op_type, _) in enumerate(wire.OP_SCHEMAS) if op_type == 'clear')
+    oplist = ops[:first_scene_op] + [{'type': 'var', 'name': 'height'}, 0, 0.5, 255, 4278190080, 'text']
+    return {'oplist': oplist, 'scene': ops[first_scene_op:], 'vars': {}}
+
+
+def main():
+    scene = sample_scene()
+    # JSON last, it's the default encoding and zlib's matches are cheaper the closer they are
+    dictionary = wire.encode(scene) + json.dumps(scene).encode()
+    encoded = base64.b64encode(dictionary).decode()
+    print(f'# {len(dictionary)} bytes, {len(wire.OP_SCHEMAS)} schemas')
+    print('COMPRESSION_DICTIONARY = base64.b64decode(')
+    for start in range(0, len(encoded), LINE_LENGTH):
+        print(f"    '{encoded[start:start + LINE_LENGTH]}'")
+    print(')')
+
+
+if __name__ == '__main__':
+    main()
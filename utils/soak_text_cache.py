@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Soak test for the text measurement cache: streams 1M distinct strings (like a live log would) through a measureTextX
+oplist entry and checks the client's memory stops growing once the cache is full. Takes a number of strings as
+argument.
+
+Memory is compared between half way through and the end, not when the cache fills up: the allocator takes a few
+times the cache's size in replaced entries to settle. Without a bound the cache grows by ~115MB per 500k strings.
+"""
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'uiclient'))
+
+from boldui import Oplist, var  # noqa: E402
+from main import UIClient  # noqa: E402
+from oplist_compiler import CompiledOplist  # noqa: E402
+
+# Growth allowed in the second half of the stream
+ALLOWED_GROWTH = 16 * 1024 * 1024
+
+
+def rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Peak instead of current, still flat if memory is
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def main():
+    string_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    cache = UIClient._text_measurement_cache
+
+    oplist = Oplist()
+    oplist.append({'type': 'measureTextX', 'fontSize': oplist.append(14), 'text': oplist.append(var('line'))})
+    evaluate = CompiledOplist(oplist.to_list(), UIClient.measure_text)
+
+    start = time.perf_counter()
+    half_rss = None
+    for i in range(string_count):
+        evaluate({'line': f'{i:>8} GET /api/items?page={i * 7919 % 1000003} 200'})
+        if i == string_count // 2:
+            half_rss = rss()
+        if i and i % (string_count // 10) == 0:
+            print(f'{i:>8} strings  {len(cache)} entries  {cache.nbytes / 2 ** 20:.1f}MB accounted  '
+                  f'rss {rss() / 2 ** 20:.1f}MB')
+    end_rss = rss()
+
+    print(f'{string_count} strings in {time.perf_counter() - start:.1f}s, {dict(cache.stats)}')
+    print(f'rss half way {half_rss / 2 ** 20:.1f}MB, at the end {end_rss / 2 ** 20:.1f}MB')
+    assert cache.stats['evictions'] >= 4 * cache.max_entries, 'the cache barely filled up, stream more strings'
+    assert len(cache) <= cache.max_entries and cache.nbytes <= cache.max_bytes
+    assert end_rss - half_rss < ALLOWED_GROWTH, 'memory kept growing'
+
+
+if __name__ == '__main__':
+    main()